@@ -0,0 +1,115 @@
+import os, os.path, json, shutil, errno
+
+class ArtifactStore(object):
+	#
+	# A local store of built packages, addressed by the hash of the recipe
+	# they were built from (see recipe.hash_recipe), so that a package
+	# that has been built before can be reused even if it isn't on any
+	# channel (e.g., it was built in another workspace sharing this store,
+	# or it failed to upload).
+	#
+	# Each package is kept in <store_dir>/<recipe_hash>/, together with an
+	# info.json with its name, version, build_number and filename. Packages
+	# are hard-linked in and out of the store where possible, so storing
+	# them costs no space as long as the conda-bld copy is around.
+	#
+	# The store is bounded in size: when it grows over max_size bytes, the
+	# least recently used packages are evicted.
+	#
+	def __init__(self, recipe_db_dir, platform, max_size):
+		self.store_dir = os.path.join(recipe_db_dir, platform, 'artifacts')
+		self.max_size = max_size
+
+		if not os.path.isdir(self.store_dir):
+			os.makedirs(self.store_dir)
+
+	def get(self, recipe_hash):
+		# Return the info dict of the package built from the recipe with the
+		# given hash, or None if there's none in the store
+		try:
+			with open(os.path.join(self.store_dir, recipe_hash, 'info.json')) as fp:
+				info = json.load(fp)
+		except (IOError, ValueError):
+			return None
+
+		if not os.path.isfile(os.path.join(self.store_dir, recipe_hash, info['filename'])):
+			return None
+		return info
+
+	def checkout(self, recipe_hash, dest_dir):
+		# Link (or copy) the package built from the recipe with the given hash
+		# into dest_dir, and mark it as recently used. Returns the path to the
+		# package in dest_dir, or None if there's a different file there
+		# already (or the package isn't in the store).
+		info = self.get(recipe_hash)
+		if info is None:
+			return None
+
+		entry = os.path.join(self.store_dir, recipe_hash)
+		src, dest = os.path.join(entry, info['filename']), os.path.join(dest_dir, info['filename'])
+		if os.path.exists(dest):
+			if not os.path.samefile(src, dest):
+				return None
+		else:
+			if not os.path.isdir(dest_dir):
+				os.makedirs(dest_dir)
+			_link_or_copy(src, dest)
+
+		os.utime(entry, None)
+		return dest
+
+	def add(self, path, recipe_hash, name, version, build_number):
+		# Add the package at path, built from the recipe with the given hash,
+		# to the store (replacing any other package built from that recipe).
+		# Evicts the least recently used packages if the store grows too big.
+		entry = os.path.join(self.store_dir, recipe_hash)
+		tmp = os.path.join(self.store_dir, '.tmp-%d-%s' % (os.getpid(), recipe_hash))
+
+		shutil.rmtree(tmp, ignore_errors=True)
+		os.makedirs(tmp)
+		try:
+			filename = os.path.basename(path)
+			_link_or_copy(path, os.path.join(tmp, filename))
+			with open(os.path.join(tmp, 'info.json'), 'w') as fp:
+				json.dump(dict(name=name, version=version, build_number=build_number, filename=filename), fp)
+
+			shutil.rmtree(entry, ignore_errors=True)
+			os.rename(tmp, entry)
+		finally:
+			shutil.rmtree(tmp, ignore_errors=True)
+
+		self.evict()
+
+	def evict(self):
+		# Remove the least recently used packages until the store is no bigger
+		# than max_size. Returns the hashes of the removed ones.
+		entries = []
+		for recipe_hash in os.listdir(self.store_dir):
+			entry = os.path.join(self.store_dir, recipe_hash)
+			if recipe_hash.startswith('.') or not os.path.isdir(entry):
+				continue
+			try:
+				size = sum(os.path.getsize(os.path.join(entry, fn)) for fn in os.listdir(entry))
+				entries.append((os.path.getmtime(entry), recipe_hash, size))
+			except OSError:
+				pass		# removed by someone else in the meantime
+
+		total = sum(size for _, _, size in entries)
+		evicted = []
+		for _, recipe_hash, size in sorted(entries):
+			if total <= self.max_size:
+				break
+			shutil.rmtree(os.path.join(self.store_dir, recipe_hash), ignore_errors=True)
+			total -= size
+			evicted.append(recipe_hash)
+		return evicted
+
+def _link_or_copy(src, dest):
+	# Hard-link src to dest, or copy it if that's not possible (e.g., they're
+	# on different filesystems)
+	try:
+		os.link(src, dest)
+	except OSError as e:
+		if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+			raise
+		shutil.copy2(src, dest)
@@ -0,0 +1,363 @@
+import os
+import os.path
+import sys
+import json
+import time
+import random
+import shutil
+import tarfile
+import tempfile
+import platform
+import contextlib
+from cStringIO import StringIO
+from collections import OrderedDict
+
+#
+# Benchmarks of the recipe pipeline (RecipeDB, RecipeMaker, version_maker)
+# against synthetic channels and manifests, so that they run offline and
+# give comparable numbers from run to run.
+#
+# For a given number of packages, we generate a file:// channel (a
+# repodata.json and fake package tarballs with info/recipe/ contents) with
+# the history of a set of products, and a manifest (in the same format as
+# samples/b1852.txt) with a DAG of those products. We then time:
+#
+#	reindex_cold		indexing the channel into an empty recipe database
+#	reindex_warm		reindexing it when nothing has changed
+#	reindex_touched		reindexing it when repodata.json has been touched (but not changed)
+#	files_to_upload		finding the local packages not on remote channels
+#	generate_cold		generating the recipes into an empty output directory
+#	generate_warm		regenerating them when nothing has changed
+#	hash_recipe		hashing all the generated recipes from disk
+#
+# Separately, the bulk reconcile of RecipeDB.reindex_channel is timed
+# against a channel with a large (by default, 50k entries) repodata.json
+# whose packages are all known to the cache already, so nothing has to be
+# downloaded:
+#
+#	reconcile_touched	reconciling when repodata.json has been touched (but not changed)
+#	reconcile_changed	reconciling when 1% of the packages have been removed, 1% renamed
+#				and 1% added (which are known from another channel)
+#
+# And the dependency closure computed by build_manifest_for_products is
+# timed against the size of two extreme DAG shapes, to check that it scales
+# linearly (per_product should stay flat as the size grows):
+#
+#	chain			a deep chain, each product depending on the one before it
+#	fanout			a wide fan-out, one product depending on all the others
+#				(which all depend on one base product)
+#
+# Before timing anything, the recipe hashes that RecipeDB.hash_package
+# computes from the streamed tarballs are checked against the ones computed
+# by extracting them with tarfile (the way it used to be done), for a sample
+# of the channel's packages and for tarballs with their info/ members out of
+# order (hash_package_checked is the number of packages checked).
+#
+# All times are in seconds.
+#
+
+def make_manifest(fn, nproducts, seed=0):
+	# Write a manifest with nproducts products, each depending on a few of
+	# the products before it (so the manifest is in build order). Returns
+	# the list of product names.
+	rnd = random.Random(seed)
+	products = [ 'bench_p%d' % i for i in xrange(nproducts) ]
+
+	lines = [ '# product                 SHA1                                      Version', 'BUILD=b0' ]
+	for i, product in enumerate(products):
+		sha = '%040x' % rnd.getrandbits(160)
+
+		# a mix of the version formats seen in real manifests (none of which needs git)
+		version = rnd.choice([ '1.%d' % i, '1.%d.lsst2' % i, '1.%d-3-g%s' % (i, sha[:7]) ])
+
+		deps = sorted(set(rnd.sample(products[:i], min(i, rnd.randint(0, 4)))))
+		lines.append('%-25s %s  %-30s %s' % (product, sha, version, ','.join(deps)))
+
+	with open(fn, 'w') as fp:
+		fp.write('\n'.join(lines) + '\n')
+	return products
+
+def make_dag_manifest(fn, shape, nproducts):
+	# Write a manifest with nproducts products in the given shape ('chain'
+	# or 'fanout', see above). Returns the name of the top-level product.
+	products = [ 'dag_p%d' % i for i in xrange(nproducts) ]
+	if shape == 'chain':
+		deps = [ products[i-1:i] for i in xrange(nproducts) ]
+	elif shape == 'fanout':
+		deps = [ [] ] + [ products[:1] ] * (nproducts - 2) + [ products[:-1] ]
+	else:
+		raise Exception("Unknown DAG shape: %s" % shape)
+
+	lines = [ '# product                 SHA1                                      Version', 'BUILD=b0' ]
+	for i, product in enumerate(products):
+		lines.append('%s %040x 1.%d %s' % (product, i, i, ','.join(deps[i])))
+
+	with open(fn, 'w') as fp:
+		fp.write('\n'.join(lines) + '\n')
+	return products[-1]
+
+def make_channel(channel_dir, platform_, npackages, products, seed=0):
+	# Create a channel in channel_dir/platform_ with npackages fake packages,
+	# spread over (the conda names of) the given products
+	rnd = random.Random(seed)
+	dir = os.path.join(channel_dir, platform_)
+	os.makedirs(dir)
+
+	packages = {}
+	for i in xrange(npackages):
+		name = 'lsst-' + products[i % len(products)].replace('_', '-')
+		version, build_number = '0.%d' % (i // len(products) // 4), i // len(products) % 4
+		fn = '%s-%s-%d.tar.bz2' % (name, version, build_number)
+
+		files = {
+			'info/index.json': json.dumps(dict(name=name, version=version, build_number=build_number)),
+			'info/recipe/meta.yaml': 'package:\n  name: "%s"\n  version: "%s"\n\nbuild:\n  number: %d\n  string: "%d"\n\nrequirements:\n  build:\n    - eups\n' % (name, version, build_number, build_number),
+			'info/recipe/build.sh': '#!/bin/bash\n# %x\n' % rnd.getrandbits(64),
+			'info/recipe/pre-link.sh': '#!/bin/bash\n',
+			'lib/libbench.so': os.urandom(256),
+		}
+		write_package(os.path.join(dir, fn), files, sorted(files))
+
+		packages[fn] = dict(name=name, version=version, build_number=build_number, size=os.path.getsize(os.path.join(dir, fn)))
+
+	with open(os.path.join(dir, 'repodata.json'), 'w') as fp:
+		json.dump(dict(packages=packages, info={}), fp)
+
+def write_package(path, files, order):
+	# Write a fake package tarball with the given files (a dict of
+	# filename -> contents), with the members in the given order
+	with contextlib.closing(tarfile.open(path, 'w:bz2')) as tf:
+		for fn in order:
+			info = tarfile.TarInfo(fn)
+			info.size = len(files[fn])
+			tf.addfile(info, StringIO(files[fn]))
+
+def reference_hash_package(path):
+	# Hash the recipe in the package at path by extracting it with tarfile
+	# from the whole (seekable) file
+	from recipe import hash_filelist
+
+	prefix = 'info/recipe/'
+	with contextlib.closing(tarfile.open(path)) as tf:
+		info = [ fn for fn in tf.getnames() if fn.startswith(prefix) ]
+		return hash_filelist(info, prefix, open=lambda fn: contextlib.closing(tf.extractfile(fn)))
+
+def check_hash_package(db, channel_dir, workdir, nsample=50, seed=0):
+	# Check that hash_package() agrees with reference_hash_package() for a
+	# sample of the packages in channel_dir, and for packages whose info/
+	# members aren't stored in sorted order. Raises an Exception if they
+	# don't; returns the number of packages checked.
+	rnd = random.Random(seed)
+	paths = sorted(os.path.join(channel_dir, fn) for fn in os.listdir(channel_dir) if fn.endswith('.tar.bz2'))
+	paths = rnd.sample(paths, min(nsample, len(paths)))
+
+	files = {
+		'info/index.json': json.dumps(dict(name='bench-layout', version='1.0', build_number=0)),
+		'info/recipe/meta.yaml': 'package:\n  name: "bench-layout"\n  version: "1.0"\n\nbuild:\n  number: 0\n',
+		'info/recipe/build.sh': '#!/bin/bash\n# %x\n' % rnd.getrandbits(64),
+		'lib/libbench.so': os.urandom(256),
+		'lib/python/bench.py': '',
+	}
+	layouts = {
+		'payload-first': [ 'lib/libbench.so', 'lib/python/bench.py', 'info/index.json', 'info/recipe/build.sh', 'info/recipe/meta.yaml' ],
+		'interleaved': [ 'info/index.json', 'lib/libbench.so', 'info/recipe/build.sh', 'lib/python/bench.py', 'info/recipe/meta.yaml' ],
+		'recipe-last': [ 'info/index.json', 'lib/libbench.so', 'lib/python/bench.py', 'info/recipe/meta.yaml', 'info/recipe/build.sh' ],
+	}
+	for layout, order in sorted(layouts.iteritems()):
+		path = os.path.join(workdir, 'bench-layout-%s.tar.bz2' % layout)
+		write_package(path, files, order)
+		paths.append(path)
+
+	for path in paths:
+		expected, got = reference_hash_package(path), db.hash_package('file://' + path)
+		if got != expected:
+			raise Exception("hash_package mismatch for %s: %s (expected %s)" % (os.path.basename(path), got, expected))
+
+	# a package without a recipe has no hash
+	path = os.path.join(workdir, 'bench-layout-norecipe.tar.bz2')
+	write_package(path, files, [ 'info/index.json', 'lib/libbench.so' ])
+	if db.hash_package('file://' + path) is not None:
+		raise Exception("hash_package returned a hash for %s, which has no recipe" % os.path.basename(path))
+
+	return len(paths) + 1
+
+@contextlib.contextmanager
+def quiet():
+	# Silence the progress output of the code being benchmarked
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, 'w')
+	try:
+		yield
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+
+def timed(fun, *args, **kwargs):
+	t0 = time.time()
+	with quiet():
+		fun(*args, **kwargs)
+	return time.time() - t0
+
+def bench_one(config, root_dir, workdir, npackages, jobs=1, seed=0):
+	# Run the benchmarks for a channel with npackages packages, returning
+	# a dict of timings
+	from recipe_db import RecipeDB
+	from recipe_maker import RecipeMaker
+	from recipe import hash_recipe
+	from utils import build_manifest_for_products
+
+	nproducts = max(10, min(npackages // 10, 1000))
+	manifest_fn = os.path.join(workdir, 'manifest.txt')
+	products = make_manifest(manifest_fn, nproducts, seed)
+
+	channel_dir = os.path.join(workdir, 'channel')
+	t0 = time.time()
+	make_channel(channel_dir, config.platform, npackages, products, seed)
+	result = OrderedDict([ ('packages', npackages), ('products', nproducts), ('setup', time.time() - t0) ])
+
+	channels = [ 'file://%s/' % channel_dir ]
+	db = RecipeDB(os.path.join(workdir, 'db'), config.platform, jobs=jobs)
+	result['hash_package_checked'] = check_hash_package(db, os.path.join(channel_dir, config.platform), workdir, seed=seed)
+	result['reindex_cold'] = timed(db.reindex, channels)
+	result['reindex_warm'] = timed(db.reindex, channels)
+	os.utime(os.path.join(channel_dir, config.platform, 'repodata.json'), None)
+	result['reindex_touched'] = timed(db.reindex, channels)
+	result['files_to_upload'] = timed(db.files_to_upload)
+
+	# Generate into a private output directory (and don't reuse any packages
+	# from the artifact store)
+	config.output_dir = os.path.join(workdir, 'recipes')
+	config.artifact_store_size = 0
+	manifest, tags = build_manifest_for_products(products, manifest_fn)
+	result['generate_products'] = len(manifest)
+	for run in ['generate_cold', 'generate_warm']:
+		generator = RecipeMaker(config, root_dir, db)
+		result[run] = timed(generator.generate, manifest, build_id=tags[0] if tags else None)
+
+	recipe_dirs = [ os.path.join(config.output_dir, name) for name in generator.products ]
+	result['hash_recipe'] = timed(lambda: [ hash_recipe(dir) for dir in recipe_dirs ])
+
+	db.close()
+	return result
+
+def write_repodata(dir, packages):
+	# Write a repodata.json listing packages, a dict of filename -> (name, version, build_number)
+	entries = dict((fn, dict(name=name, version=version, build_number=build_number, md5='0' * 32, size=1024, depends=[]))
+		for fn, (name, version, build_number) in packages.iteritems())
+	with open(os.path.join(dir, 'repodata.json'), 'w') as fp:
+		json.dump(dict(packages=entries, info={}), fp)
+
+def bench_reconcile(config, workdir, nentries, seed=0):
+	# Time the bulk reconcile of a channel with nentries packages in its
+	# repodata.json, all of which are in the cache already. Returns a dict
+	# of timings.
+	from recipe_db import RecipeDB, Channel, Package, get_or_create
+
+	rnd = random.Random(seed)
+	packages = {}
+	for i in xrange(nentries):
+		key = ('lsst-bench-p%d' % (i // 20), '1.%d' % (i % 20 // 4), i % 4)
+		packages['%s-%s-%d.tar.bz2' % key] = key
+
+	dir = os.path.join(workdir, 'reconcile', config.platform)
+	os.makedirs(dir)
+	write_repodata(dir, packages)
+
+	# Populate the cache: the channel itself, and another one that also
+	# has the packages added below
+	n = max(1, nentries // 100)
+	added = dict(('lsst-bench-new%d-1.0-0.tar.bz2' % i, ('lsst-bench-new%d' % i, '1.0', 0)) for i in xrange(n))
+
+	db = RecipeDB(os.path.join(workdir, 'db-reconcile'), config.platform)
+	urlbase = 'file://%s/' % os.path.dirname(dir)
+	channel = get_or_create(db._session, Channel, urlbase=urlbase)
+	other = get_or_create(db._session, Channel, urlbase='file://%s/' % os.path.join(workdir, 'reconcile-other'))
+	for ch, pkgs in [ (channel, packages), (other, dict(packages, **added)) ]:
+		db._add_packages(ch, [ (key, fn, '%040x' % rnd.getrandbits(160)) for fn, key in pkgs.iteritems() ])
+	db._session.commit()
+
+	result = OrderedDict([ ('entries', nentries) ])
+	result['reconcile_touched'] = timed(db.reindex_channel, channel)
+
+	fns = sorted(packages)
+	rnd.shuffle(fns)
+	for fn in fns[:n]:
+		del packages[fn]
+	for fn in fns[n:2*n]:
+		packages[fn.replace('.tar.bz2', '.renamed.tar.bz2')] = packages.pop(fn)
+	packages.update(added)
+	write_repodata(dir, packages)
+	result['reconcile_changed'] = timed(db.reindex_channel, channel)
+
+	# Check that the cache now matches repodata.json
+	cached = dict((fn, (name, version, build_number)) for fn, name, version, build_number in
+		db._session.query(Package.filename, Package.name, Package.version, Package.build_number).filter(Package.channel_id == channel.id))
+	if cached != packages:
+		raise Exception("reconcile left the cache inconsistent with repodata.json")
+
+	db.close()
+	return result
+
+def bench_closure(workdir, sizes):
+	# Time build_manifest_for_products (best of three runs) on chain and
+	# fan-out DAGs of the given sizes. Returns a list of dicts of timings.
+	from utils import build_manifest_for_products
+
+	results = []
+	for shape in ['chain', 'fanout']:
+		for nproducts in sizes:
+			fn = os.path.join(workdir, 'dag-%s-%d.txt' % (shape, nproducts))
+			top = make_dag_manifest(fn, shape, nproducts)
+
+			t = None
+			for _ in xrange(3):	# best of three, to filter out noise
+				t0 = time.time()
+				manifest, _ = build_manifest_for_products([ top ], fn)
+				t = min(t, time.time() - t0) if t is not None else time.time() - t0
+
+			if len(manifest) != nproducts or next(reversed(manifest)) != top:
+				raise Exception("build_manifest_for_products returned a wrong closure for the %d-product %s" % (nproducts, shape))
+			results.append(OrderedDict([ ('shape', shape), ('products', nproducts), ('closure', t), ('per_product', t / nproducts) ]))
+
+	return results
+
+def run_benchmarks(config, root_dir, sizes, jobs=1, workdir=None, seed=0, reconcile_size=50000, dag_sizes=()):
+	# Run the benchmarks for each of the channel sizes. Returns a
+	# JSON-serializable dict with the results. Progress is reported on
+	# stderr, so the results can be written to stdout.
+	results = OrderedDict([
+		('timestamp', time.time()),
+		('python', platform.python_version()),
+		('platform', config.platform),
+		('jobs', jobs),
+		('results', []),
+	])
+
+	for npackages in sizes:
+		dir = tempfile.mkdtemp(prefix='conda-lsst-bench-', dir=workdir)
+		try:
+			print >>sys.stderr, "benchmarking with %d packages..." % npackages,
+			results['results'].append(bench_one(config, root_dir, dir, npackages, jobs=jobs, seed=seed))
+			print >>sys.stderr, "done."
+		finally:
+			shutil.rmtree(dir, ignore_errors=True)
+
+	if reconcile_size:
+		dir = tempfile.mkdtemp(prefix='conda-lsst-bench-', dir=workdir)
+		try:
+			print >>sys.stderr, "benchmarking reconcile with %d repodata entries..." % reconcile_size,
+			results['reconcile'] = bench_reconcile(config, dir, reconcile_size, seed=seed)
+			print >>sys.stderr, "done."
+		finally:
+			shutil.rmtree(dir, ignore_errors=True)
+
+	if dag_sizes:
+		dir = tempfile.mkdtemp(prefix='conda-lsst-bench-', dir=workdir)
+		try:
+			print >>sys.stderr, "benchmarking dependency closures...",
+			results['closure'] = bench_closure(dir, dag_sizes)
+			print >>sys.stderr, "done."
+		finally:
+			shutil.rmtree(dir, ignore_errors=True)
+
+	return results
@@ -0,0 +1,207 @@
+import os, os.path, sys, json, subprocess, threading, time, heapq
+from collections import OrderedDict
+from Queue import Queue
+
+def format_duration(seconds):
+	# Format a duration in seconds as H:MM:SS
+	seconds = int(round(seconds))
+	return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+class BuildScheduler(object):
+	#
+	# Builds the recipes generated by RecipeMaker, running up to `jobs` builds
+	# at the same time. A package is built as soon as all of its dependencies
+	# have been built; if a build fails, its dependents are not built, but
+	# the unrelated branches of the dependency graph are.
+	#
+	# When more packages are ready to build than there are free jobs, the ones
+	# on the longest (critical) path to the end of the build go first. Paths
+	# are weighted by build times recorded in the recipe database by previous
+	# runs.
+	#
+	# The graph is read from build-plan.json in the output directory, and
+	# each package is built by calling 'rebuild.sh <package>', so the usual
+	# .done/.skip.$PLATFORM markers, _build.log capture and container
+	# re-execution all apply.
+	#
+	# Note: parallel builds need a conda-build that uses a separate work
+	# directory for each build (conda-build 2.0 or later).
+	#
+	def __init__(self, output_dir, jobs=1, db=None, package_dir=None, artifacts=None):
+		self.output_dir = output_dir
+		self.jobs = max(1, jobs)
+		self.db = db
+		self.package_dir = package_dir		# where conda-build puts the built packages
+		self.artifacts = artifacts		# ArtifactStore to add the built packages to (needs db and package_dir)
+		self.platform = os.uname()[0]		# what `uname` returns in rebuild.sh
+
+		with open(os.path.join(output_dir, 'build-plan.json')) as fp:
+			plan = json.load(fp)
+		self.build_id = plan['build_id']
+		self.plan = OrderedDict((node['name'], node) for node in plan['packages'])
+
+	def is_done(self, name):
+		# Has this package been built already (or should it be skipped)?
+		dir = os.path.join(self.output_dir, name)
+		return os.path.isfile(os.path.join(dir, '.done')) or os.path.isfile(os.path.join(dir, '.skip.' + self.platform))
+
+	def build(self, name):
+		# Build a single package. Returns (success, output, usage), where usage
+		# is a dict with the resources used by the build (see recipe_db.Build)
+		t0 = time.time()
+		cmd = ['bash', os.path.join(self.output_dir, 'rebuild.sh'), name]
+		proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		output = proc.stdout.read()
+
+		# Reap the process ourselves, to get the resource usage of the whole
+		# process tree (conda build, compilers, etc.)
+		_, status, ru = os.wait4(proc.pid, 0)
+		proc.returncode = status
+
+		usage = dict(
+			duration = time.time() - t0,
+			cpu_user = ru.ru_utime,
+			cpu_sys  = ru.ru_stime,
+			max_rss  = ru.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),	# bytes on OS X, kilobytes on Linux
+		)
+
+		node = self.plan[name]
+		if self.package_dir is not None:
+			fn = os.path.join(self.package_dir, '%s-%s-%s.tar.bz2' % (name, node['version'], node['build_string']))
+			if os.path.isfile(fn):
+				usage['size'] = os.path.getsize(fn)
+
+		return status == 0, output, usage
+
+	def store(self, name):
+		# Add a freshly built package to the artifact store, keyed by the hash
+		# of its recipe (see RecipeMaker.get_build_info)
+		if self.artifacts is None or self.package_dir is None:
+			return
+
+		node = self.plan[name]
+		fn = os.path.join(self.package_dir, '%s-%s-%s.tar.bz2' % (name, node['version'], node['build_string']))
+		if not os.path.isfile(fn):
+			return
+
+		from recipe_db import read_package_files
+		from recipe import hash_recipe
+		info = json.loads(read_package_files('file://' + os.path.abspath(fn), 'info/index.json')['info/index.json'])
+		self.artifacts.add(fn, hash_recipe(os.path.join(self.output_dir, name)), info['name'], info['version'], info['build_number'])
+
+	def deps(self, name):
+		# The dependencies of name that are a part of this build
+		return [ dep for dep in self.plan[name]['deps'] if dep in self.plan ]
+
+	def priorities(self, names, weights):
+		# Return the length of the longest path from each of the names to the
+		# end of the build (including the package itself).
+		priority = {}
+		for name in reversed(names):		# dependents come after dependencies in plan order
+			priority.setdefault(name, 0.)
+			priority[name] += weights[name]
+			for dep in self.deps(name):
+				if dep in weights:
+					priority[dep] = max(priority.get(dep, 0.), priority[name])
+		return priority
+
+	def simulate(self, names, weights, priority):
+		# Predict the wall clock time needed to build names, by running the
+		# scheduling algorithm with the given weights as build times.
+		pending = list(names)
+		done = set(self.plan) - set(names)
+		running, now = [], 0.
+		while pending or running:
+			ready = [ name for name in pending if all(dep in done for dep in self.deps(name)) ]
+			ready.sort(key=lambda name: -priority[name])
+			for name in ready[:self.jobs - len(running)]:
+				pending.remove(name)
+				heapq.heappush(running, (now + weights[name], name))
+
+			if not running:
+				break	# circular dependency; run() will complain
+
+			now, name = heapq.heappop(running)
+			done.add(name)
+		return now
+
+	def run(self):
+		# Build everything that needs building. Returns the list of packages
+		# that failed to build.
+		pending = [ name for name in self.plan if not self.is_done(name) ]
+		done = set(self.plan) - set(pending)
+		failed, blocked = [], []
+
+		# Weigh the packages with their expected build times
+		if self.db is not None:
+			estimates = self.db.estimate_build_times([ (name, self.plan[name]['version']) for name in pending ])
+			weights = dict((name, estimates[name, self.plan[name]['version']]) for name in pending)
+		else:
+			weights = dict((name, 1.) for name in pending)
+		priority = self.priorities(pending, weights)
+
+		print "building %d packages (%d already built) using %d job(s):" % (len(pending), len(done), self.jobs)
+		predicted = None
+		if self.db is not None and pending:
+			predicted = self.simulate(pending, weights, priority)
+			print "  predicted build time: %s (critical path: %s)" % (format_duration(predicted), format_duration(max(priority.values())))
+		sys.stdout.flush()
+
+		results = Queue()
+		def worker(name):
+			try:
+				success, output, usage = self.build(name)
+			except Exception as e:
+				success, output, usage = False, "  %s: %s\n" % (name, e), None
+			results.put((name, success, output, usage))
+
+		start, running = time.time(), set()
+		while pending or running:
+			# Launch the packages whose dependencies have been built, most critical first
+			ready = [ name for name in pending if all(dep in done for dep in self.deps(name)) ]
+			ready.sort(key=lambda name: -priority[name])
+			for name in ready[:self.jobs - len(running)]:
+				pending.remove(name)
+				running.add(name)
+
+				thread = threading.Thread(target=worker, args=(name,))
+				thread.daemon = True
+				thread.start()
+
+			if not running:
+				raise Exception("Circular dependency among packages: %s" % ', '.join(pending))
+
+			# Wait for a build to finish
+			name, success, output, usage = results.get()
+			running.remove(name)
+
+			sys.stdout.write(output)
+			sys.stdout.flush()
+
+			if self.db is not None and usage is not None:
+				self.db.record_build(name, self.plan[name]['version'], build_id=self.build_id, success=success, **usage)
+
+			if success:
+				done.add(name)
+				self.store(name)
+			else:
+				failed.append(name)
+
+				# Don't build anything that depends on the failed package. As the plan
+				# is topologically sorted, one pass is enough to find all dependents.
+				for dname in list(pending):
+					if any(dep in failed or dep in blocked for dep in self.deps(dname)):
+						pending.remove(dname)
+						blocked.append(dname)
+
+		if predicted is not None:
+			print "  actual build time: %s (predicted: %s)" % (format_duration(time.time() - start), format_duration(predicted))
+
+		if failed:
+			print "failed to build: %s" % ', '.join(failed)
+			if blocked:
+				print "not built because of failed dependencies: %s" % ', '.join(blocked)
+		else:
+			print "done."
+
+		return failed
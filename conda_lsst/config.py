@@ -1,10 +1,10 @@
+import os
 import os.path
 import platform
 import re
 import sys
 import fnmatch
-
-import yaml
+import cPickle
 
 def expand_path(root, fragment):
 	if not os.path.isabs(fragment):
@@ -37,6 +37,39 @@ class Config(object):
 	# string, mapped from config.recipe_db_dir
 	recipe_db_dir = None
 
+	# A local clone of versiondb (and where to clone it from), from which
+	# 'build:<tag>' manifests are loaded. The parsed manifests (and an index
+	# of which builds include which products) are cached in recipe_db_dir.
+	#
+	# string, mapped from config.versiondb_dir and config.versiondb_url
+	versiondb_dir = None
+	versiondb_url = None
+
+	# Number of packages to download and hash in parallel when refreshing the
+	# recipe database from remote channels.
+	#
+	# int, mapped from config.reindex_jobs
+	reindex_jobs = None
+
+	# Number of git mirrors (in repo-cache) to refresh in parallel when looking
+	# up the commit timestamps of <branch>-g<sha1> versions, and the time (in
+	# seconds) a single clone or update is allowed to take.
+	#
+	# int, mapped from config.git_jobs and config.git_timeout
+	git_jobs = None
+	git_timeout = None
+
+	# Maximum size (in bytes) of the store of previously built packages, kept in
+	# recipe_db_dir (see artifact_store.py); 0 disables the store.
+	#
+	# int, mapped from config.artifact_store_size (in GB)
+	artifact_store_size = None
+
+	# Number of packages to build in parallel (conda lsst build)
+	#
+	# int, mapped from config.build_jobs
+	build_jobs = None
+
 	#
 	# Directory with additional recipes, to satisfy any injected dependencies.
 	# These are most often conda packages for packages out of PyPI, typically
@@ -99,6 +132,17 @@ class Config(object):
 	# dict( upstream_url_pattern -> [ productGlob1, productGlob2, ... ] ), mapped from config.git-upstreams
 	git_upstreams = None
 
+	# The rules of git_upstreams and missing_deps, with the globs precompiled
+	# (in the order they're tried), and the per-product results of matching
+	# them (memoised by match_upstream() and match_missing_deps()).
+	#
+	# list of ( upstream_url_pattern, productGlob, regex )
+	# list of ( condaGlob, configKey, regex, deps ), where configKey is the key in config.dependencies
+	_upstream_rules = None
+	_missing_deps_rules = None
+	_upstream_matches = None
+	_missing_deps_matches = None
+
 	# Override SHA1s
 	#
 	# list of ( 'product_name' -> 'SHA1-or-ref' ), mapped from config.override_gitrev
@@ -119,6 +163,7 @@ class Config(object):
 	channel_server       = None
 	channel_dir_base     = None
 	channel_server_conda = None
+	channel_upload_jobs  = None		# number of files to upload in parallel
 
 	#
 	# You should not need to manipulate this; change our_channel_regex instead
@@ -128,6 +173,9 @@ class Config(object):
 	# channel names
 	channel_names = None
 
+	# The conda-build root directory; built packages are stored in <croot>/<platform>
+	croot = None
+
 	platform = None
 	uname = None
 
@@ -152,26 +200,47 @@ class Config(object):
 
 		return self.lsst_prefix + transformed_name
 
+	def match_upstream(self, productName):
+		# Return the (remote, glob) of the first remote in whose list of
+		# product globs there's at least one that our productName matches
+		# (or (None, None), if there isn't one)
+		try:
+			return self._upstream_matches[productName]
+		except KeyError:
+			pass
+
+		match = next(((remote, glob) for remote, glob, regex in self._upstream_rules if regex.match(productName)), (None, None))
+		self._upstream_matches[productName] = match
+		return match
+
 	def get_giturl(self, productName):
-		# Find first remote in whose list of product globs there's
-		# at least one that our productName matches
-		for remote, productNameGlobs in self.git_upstreams.items():
-			if next((glob for glob in productNameGlobs if fnmatch.fnmatch(productName, glob)), None):
-				return remote % { 'product': productName }
+		remote, _ = self.match_upstream(productName)
+		if remote is not None:
+			return remote % { 'product': productName }
 
-	def get_missing_deps(self, productName, typ):
-		# Find all keys in self.missing_deps that match productName
-		# Then return the union of all dependencies of the matching type
-		# (note: returns a generator)
-		matching = [ deps.get(typ, []) for glob, deps in self.missing_deps.items() if fnmatch.fnmatch(productName, glob) ]
+	def match_missing_deps(self, productName):
+		# Return the list of (glob, configKey, deps) of all entries in
+		# self.missing_deps whose keys match productName
+		try:
+			return self._missing_deps_matches[productName]
+		except KeyError:
+			pass
 
-		from itertools import chain
-		return chain.from_iterable(matching)
+		matches = [ (glob, key, deps) for glob, key, regex, deps in self._missing_deps_rules if regex.match(productName) ]
+		self._missing_deps_matches[productName] = matches
+		return matches
+
+	def get_missing_deps(self, productName, typ):
+		# Return the union of all dependencies of the matching type, from all
+		# entries in self.missing_deps that match productName
+		return [ dep for _, _, deps in self.match_missing_deps(productName) for dep in deps.get(typ, []) ]
 
 	def __init__(self, root_dir, fns):
 		# Load the configuration file (YAML), do any necessary parsing
 		# and variable substitutions, and return the result
 
+		import yaml
+
 		# Load and merge all configuration files
 		config = {}
 		for fn in fns:
@@ -218,8 +287,10 @@ class Config(object):
 
 		# Parse system-provided dependencies specifications
 		_deps = {}
+		_keys = {}
 		pv = config['pin_versions']
 		for productName, deps in config['dependencies'].items():
+			key = productName
 			#
 			# By default, the key is an EUPS name, but allow it to be a
 			# conda name as well
@@ -241,6 +312,7 @@ class Config(object):
 			# EUPS names as well.
 			#
 			_deps[productName] = {}
+			_keys[productName] = key
 			for type_ in ['run', 'build']:
 				if type_ in deps:
 					newDeps = []
@@ -266,6 +338,13 @@ class Config(object):
 		# Set member variables
 		self.output_dir = expand_path(root_dir, config['output_dir'])
 		self.recipe_db_dir = expand_path(root_dir, config['recipe_db_dir'])
+		self.versiondb_dir = expand_path(root_dir, config.get('versiondb_dir', 'versiondb'))
+		self.versiondb_url = config.get('versiondb_url', 'https://github.com/lsst/versiondb')
+		self.reindex_jobs = config.get('reindex_jobs', 1)
+		self.build_jobs = config.get('build_jobs', 1)
+		self.artifact_store_size = int(config.get('artifact_store_size', 0) * 1024**3)
+		self.git_jobs = config.get('git_jobs', 1)
+		self.git_timeout = config.get('git_timeout', None)
 		self.additional_recipes_dir = expand_path(root_dir, config['additional_recipes_dir'])
 		self.template_dir = expand_path(root_dir, config['template_dir'])
 		self.patch_dir = expand_path(root_dir, config['patch_dir'])
@@ -274,22 +353,29 @@ class Config(object):
 
 		# Dependencies
 		self.missing_deps = config['dependencies']
+		self._missing_deps_rules = [ (glob, _keys[glob], re.compile(fnmatch.translate(glob)), deps) for glob, deps in self.missing_deps.items() ]
+		self._missing_deps_matches = {}
 
 		self.global_eups_tags = [ 'current', 'conda' ]
 
 		# obtaining the source
 		self.git_upstreams = config['git-upstreams']
+		self._upstream_rules = [ (remote, glob, re.compile(fnmatch.translate(glob))) for remote, globs in self.git_upstreams.items() for glob in globs ]
+		self._upstream_matches = {}
 		self.override_gitrev = config['override_gitrev']
 
 		# Upload support
 		self.channel_server       = config['upload']['server']
 		self.channel_dir_base     = config['upload']['dir_base']
 		self.channel_server_conda = config['upload']['conda']
+		self.channel_upload_jobs  = config['upload'].get('jobs', 1)
 
 		# Conda channel management
 		self.our_channel_regex = config['our_channel_regex']
 
 		from conda_build.config import croot
+		self.croot = croot
+
 		# channel URLs
 		self.channels = [
 			'file://%s/' % croot,
@@ -302,8 +388,59 @@ class Config(object):
 		self.platform = "%s-%s" % ('osx' if sys.platform == 'darwin' else 'linux', platform.architecture()[0][:2])
 		self.uname = sys.platform.title()
 
+	def channel_url(self, name):
+		# Return the URL of our channel with the given name (one of channel_names)
+		for chan in self.channels:
+			match = re.match(self.our_channel_regex, chan)
+			if match and match.group(1) == name:
+				return chan
+		raise KeyError(name)
+
 ######################################################
 
+def _config_cache_key(root_dir, fns):
+	# Everything the resolved Config depends on: the config files, conda's
+	# configuration (for the channels and croot), and this code
+	condarcs = [ os.environ.get('CONDARC', '~/.condarc'), os.path.join(sys.prefix, '.condarc') ]
+	paths = [ expand_path(root_dir, os.path.expanduser(fn)) for fn in fns + condarcs ] + [ __file__.rstrip('c') ]
+	def mtime(path):
+		try:
+			return os.path.getmtime(path)
+		except OSError:
+			return None
+	return [ (path, mtime(path)) for path in paths ] + [ os.environ.get('CONDA_BLD_PATH'), sys.prefix ]
+
+def load_config(root_dir, fns, cache_fn):
+	#
+	# Return Config(root_dir, fns), from the cache in cache_fn if none of
+	# the files it was resolved from have changed since it was cached.
+	#
+	# Resolving the configuration means importing conda and conda-build,
+	# which takes much longer than anything most subcommands do.
+	#
+	key = _config_cache_key(root_dir, fns)
+	try:
+		with open(cache_fn, 'rb') as fp:
+			cached_key, state = cPickle.load(fp)
+		if cached_key == key:
+			config = Config.__new__(Config)
+			config.__dict__.update(state)
+			return config
+	except Exception:
+		pass				# no cache (or an unreadable one)
+
+	config = Config(root_dir, fns)
+
+	try:
+		tmp_fn = '%s.%d' % (cache_fn, os.getpid())
+		with open(tmp_fn, 'wb') as fp:
+			cPickle.dump((key, config.__dict__), fp, cPickle.HIGHEST_PROTOCOL)
+		os.rename(tmp_fn, cache_fn)
+	except (IOError, OSError):
+		pass				# caching is an optimization; carry on without it
+
+	return config
+
 def _get_our_channels(regex):
 	""" Return channels from .condarc that match regex """
 	from urlparse import urljoin
@@ -0,0 +1,161 @@
+import os
+import os.path
+import re
+import sys
+import glob
+import subprocess
+
+import sqlalchemy
+from sqlalchemy import Column, Integer, String, ForeignKey, UniqueConstraint, Index
+from sqlalchemy.ext.declarative import declarative_base
+
+from utils import parse_manifest
+
+Base = declarative_base()
+class Manifest(Base):
+	# A build manifest from versiondb (manifests/<tag>.txt)
+	__tablename__ = 'manifests'
+
+	tag          = Column(String, primary_key=True)	# e.g., b1852
+	build_id     = Column(String)			# the BUILD= line of the manifest (usually == tag)
+
+class ManifestEntry(Base):
+	# A (product, sha, version, deps) line of a manifest. Most lines are
+	# shared by many manifests, so each distinct line is stored only once.
+	__tablename__ = 'manifest_entries'
+	__table_args__ = (
+		UniqueConstraint('product', 'sha', 'version', 'deps'),
+		Index('ix_manifest_entries_product_version', 'product', 'version'),
+		{'sqlite_autoincrement': True}
+	)
+
+	id           = Column(Integer, primary_key=True)
+
+	product      = Column(String)
+	sha          = Column(String)
+	version      = Column(String)
+	deps         = Column(String)			# comma-separated list of dependencies
+
+class ManifestLine(Base):
+	# The entries making up a manifest, in order. The index on entry_id
+	# makes this the inverted (product -> build tags) index.
+	__tablename__ = 'manifest_lines'
+	__table_args__ = (
+		Index('ix_manifest_lines_entry_id', 'entry_id'),
+	)
+
+	tag          = Column(String, ForeignKey('manifests.tag'), primary_key=True)
+	position     = Column(Integer, primary_key=True)
+	entry_id     = Column(Integer, ForeignKey('manifest_entries.id'))
+
+def tag_sort_key(tag):
+	# Sort build tags numerically (b999 before b1000)
+	match = re.match(r'^b([0-9]+)$', tag)
+	return (0, int(match.group(1)), '') if match else (1, 0, tag)
+
+class ManifestStore(object):
+	#
+	# A local store of versiondb build manifests, so that 'build:bNNNN'
+	# manifests can be loaded (and searched) without going to the network.
+	#
+	# The manifests are read from a local clone of versiondb, parsed once,
+	# and kept in an SQLite database that also serves as an index of which
+	# builds contain which products (and product versions). New manifests
+	# are added to the database incrementally, as they appear in the clone.
+	#
+	def __init__(self, store_dir, versiondb_dir, versiondb_url):
+		self.versiondb_dir = versiondb_dir
+		self.versiondb_url = versiondb_url
+		self._updated = False		# has the versiondb clone been updated in this run?
+
+		dbfn = os.path.join(store_dir, 'manifests.sqlite')
+		if not os.path.isdir(store_dir):
+			os.makedirs(store_dir)
+
+		self.engine = sqlalchemy.create_engine('sqlite:///%s' % dbfn, echo=False)
+		Base.metadata.create_all(self.engine)
+
+	def update(self):
+		# Clone (or pull) the versiondb repository. If the pull fails (e.g.,
+		# we're offline), carry on with what we have.
+		if self._updated:
+			return
+		self._updated = True
+
+		if not os.path.isdir(self.versiondb_dir):
+			print "cloning %s into %s..." % (self.versiondb_url, self.versiondb_dir)
+			sys.stdout.flush()
+			subprocess.check_call(['git', 'clone', '--quiet', self.versiondb_url, self.versiondb_dir])
+		else:
+			try:
+				subprocess.check_call(['git', 'pull', '--quiet'], cwd=self.versiondb_dir)
+			except subprocess.CalledProcessError:
+				print >>sys.stderr, "warning: failed to update %s; using the local copy." % self.versiondb_dir
+
+	def sync(self):
+		# Add the manifests from the versiondb clone that aren't in the
+		# database yet. Returns the number of manifests added.
+		fns = glob.glob(os.path.join(self.versiondb_dir, 'manifests', '*.txt'))
+
+		with self.engine.begin() as conn:
+			known = set(tag for (tag,) in conn.execute(sqlalchemy.select([Manifest.tag])))
+			new = sorted((tag for tag in (os.path.basename(fn)[:-4] for fn in fns) if tag not in known), key=tag_sort_key)
+			if not new:
+				return 0
+
+			entries = dict(((product, sha, version, deps), id) for (id, product, sha, version, deps) in conn.execute(
+				sqlalchemy.select([ManifestEntry.id, ManifestEntry.product, ManifestEntry.sha, ManifestEntry.version, ManifestEntry.deps])))
+
+			for tag in new:
+				with open(os.path.join(self.versiondb_dir, 'manifests', tag + '.txt')) as fp:
+					build_id, manifest_lines = parse_manifest(fp.read().split('\n'))
+
+				lines = []
+				for position, (product, sha, version, deps) in enumerate(manifest_lines):
+					key = (product, sha, version, ','.join(deps))
+					if key not in entries:
+						entries[key] = conn.execute(ManifestEntry.__table__.insert().values(
+							product=product, sha=sha, version=version, deps=key[3])).inserted_primary_key[0]
+					lines.append(dict(tag=tag, position=position, entry_id=entries[key]))
+
+				conn.execute(Manifest.__table__.insert().values(tag=tag, build_id=build_id))
+				if lines:
+					conn.execute(ManifestLine.__table__.insert(), lines)
+
+		return len(new)
+
+	def get(self, tag):
+		# Return (build_id, manifest_lines) for the manifest with the given
+		# tag, in the format returned by utils.load_manifest(). Goes to the
+		# network only if the manifest isn't in the local versiondb clone.
+		for attempt in xrange(2):
+			self.sync()
+			with self.engine.connect() as conn:
+				manifest = conn.execute(sqlalchemy.select([Manifest.build_id]).where(Manifest.tag == tag)).first()
+				if manifest is not None:
+					rows = conn.execute(
+						sqlalchemy.select([ManifestEntry.product, ManifestEntry.sha, ManifestEntry.version, ManifestEntry.deps])
+						.select_from(ManifestLine.__table__.join(ManifestEntry.__table__))
+						.where(ManifestLine.tag == tag)
+						.order_by(ManifestLine.position))
+					# (convert back to str, as returned by load_manifest, from the unicode SQLite gives us)
+					build_id = str(manifest.build_id) if manifest.build_id is not None else None
+					return build_id, [ (str(product), str(sha), str(version), str(deps).split(',') if deps else []) for (product, sha, version, deps) in rows ]
+
+			if self._updated:
+				break
+			self.update()
+
+		raise Exception("Build %s not found in versiondb (%s)" % (tag, self.versiondb_dir))
+
+	def what_builds(self, product, version=None):
+		# Return the (sorted) list of build tags whose manifests include the
+		# product (at the given version, if any)
+		query = (sqlalchemy.select([ManifestLine.tag]).distinct()
+			.select_from(ManifestLine.__table__.join(ManifestEntry.__table__))
+			.where(ManifestEntry.product == product))
+		if version is not None:
+			query = query.where(ManifestEntry.version == version)
+
+		with self.engine.connect() as conn:
+			return sorted((str(tag) for (tag,) in conn.execute(query)), key=tag_sort_key)
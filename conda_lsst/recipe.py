@@ -0,0 +1,180 @@
+import os, os.path, sys, hashlib, contextlib
+from cStringIO import StringIO
+
+class Recipe(object):
+	#
+	# A conda recipe held in memory, as a dict of (relative filename -> contents).
+	# This lets RecipeMaker render, hash, and compare recipes with what's
+	# already on disk without writing anything out, and then write each file
+	# of the recipes that changed exactly once.
+	#
+	def __init__(self, files=None, modes=None):
+		self.files = dict(files or {})
+		self.modes = dict(modes or {})	# (filename -> permission bits), for files copied from elsewhere
+
+	@staticmethod
+	def from_dir(dir, ignore=lambda fn: False):
+		# Load a recipe from a directory, skipping the files for which
+		# ignore(relative_filename) returns True
+		recipe = Recipe()
+		for root, dirs, files in os.walk(dir):
+			for fn in files:
+				path = os.path.join(root, fn)
+				rel_fn = os.path.relpath(path, dir)
+				if ignore(rel_fn):
+					continue
+
+				with open(path, 'rb') as fp:
+					recipe.files[rel_fn] = fp.read()
+				recipe.modes[rel_fn] = os.stat(path).st_mode & 0777
+		return recipe
+
+	def digest(self):
+		# A digest of the filenames and (exact) contents of the recipe
+		m = hashlib.sha1()
+		for fn in sorted(self.files):
+			m.update("%s  %s\n" % (hashlib.sha1(self.files[fn]).hexdigest(), fn))
+		return m.hexdigest()
+
+	def set_build_number(self, buildnum):
+		# Set the build number in meta.yaml, adding a 'build:' section if there
+		# isn't one. Build strings that are just the build number are updated
+		# as well. The number goes where hash_filelist() expects it
+		# (in the lines following 'build:'), so it doesn't change the hash.
+		lines = self.files['meta.yaml'].splitlines(True)
+		if lines and not lines[-1].endswith('\n'):
+			lines[-1] += '\n'
+
+		if 'build:\n' not in lines:
+			lines += [ '\n', 'build:\n', '  number: %d\n' % buildnum ]
+		else:
+			start = lines.index('build:\n') + 1
+			end = next((i for i in xrange(start, len(lines)) if not lines[i].strip()), len(lines))
+
+			numbered = False
+			for i in xrange(start, end):
+				indent = lines[i][:len(lines[i]) - len(lines[i].lstrip())]
+				key, _, value = lines[i].strip().partition(':')
+				if key == 'number':
+					lines[i] = '%snumber: %d\n' % (indent, buildnum)
+					numbered = True
+				elif key == 'string' and value.strip().strip('"\'').isdigit():
+					lines[i] = '%sstring: "%d"\n' % (indent, buildnum)
+
+			if not numbered:
+				indent = lines[start][:len(lines[start]) - len(lines[start].lstrip())] if start < end else ''
+				lines.insert(start, '%snumber: %d\n' % (indent or '  ', buildnum))
+
+		self.files['meta.yaml'] = ''.join(lines)
+
+	def write(self, dir):
+		# Write the recipe out into dir (which must not exist)
+		os.makedirs(dir)
+		for fn, contents in self.files.iteritems():
+			path = os.path.join(dir, fn)
+			if not os.path.isdir(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+
+			with open(path, 'wb') as fp:
+				fp.write(contents)
+			if fn in self.modes:
+				os.chmod(path, self.modes[fn])
+
+#
+# Recipe hashes: a hash of the files of a recipe that conda-build copies into
+# the package (info/recipe/), ignoring the build number, so that it can be
+# computed from the recipe directory before the build and looked up in the
+# packages on the channels afterwards (see RecipeDB).
+#
+
+def hash_filelist(filelist, ignore_prefix='', open=open, verbose=False):
+	m = hashlib.sha1()
+
+	if False:
+		# Echo the output to the screen
+		def update(m, s):
+			sys.stdout.write("%s" % s)
+			return m.update(s)
+	else:
+		def update(m, s): return m.update(s)
+
+	for fn in sorted(filelist):
+		# Ignore all files that *don't* end in the following suffixes
+		suffixes = [ '.patch', '.yaml', '.patch', '.diff', '.sh' ]	# FIXME: make this configurable somehow
+		for suffix in suffixes:
+			if fn.endswith(suffix):
+				break
+
+			# Special handling for meta.yaml, to work around the change introduced in conda-build 1.20.3
+			# https://github.com/conda/conda-build/commit/b4ec0e0659d8f376042d4fc391616bf235996cf5 where
+			# meta.yaml is now stored in the recipe dir as meta.yaml.template
+			if fn.endswith('/meta.yaml.template'):
+				break
+		else:
+			continue
+
+		mm = hashlib.sha1()
+		with open(fn) as fp:
+			rel_fn = fn[len(ignore_prefix):]
+
+			# Special handling for meta.yaml, to work around the change introduced in conda-build 1.20.3
+			# https://github.com/conda/conda-build/commit/b4ec0e0659d8f376042d4fc391616bf235996cf5 where
+			# meta.yaml is now stored in the recipe dir as meta.yaml.template
+			if rel_fn == 'meta.yaml.template':
+				rel_fn = 'meta.yaml'
+
+			# Special handling of some files:
+			if rel_fn == 'meta.yaml':
+				# remove build number and modify the build string from the meta.yaml file
+				# build:
+				#   number: 0
+				#   string: "blah_0"
+				state = 0	# 0: scan for build, 1: scan for number: 2: pass through the rest of the file
+				buildnum = None
+				for line in fp:
+					if state == 0 and line == 'build:\n':
+						state = 1
+					elif state == 1 and line.strip().startswith('number:'):
+						line = ''	# don't write out the build number
+					elif state == 1 and line.strip().startswith('string:'):
+						line = ''	# strip out the build string -- it encodes the buildnum as well
+								# FIXME: not sure what happens if we decide to change the buildstr prefix?
+					elif state == 1 and not line.strip():
+						state = 2	# didn't have an explicit number:
+
+					mm.update(line)
+			else:
+				# Just add the file contents
+				mm.update(fp.read())
+
+		# Update the list hash
+		res = "%s  %s\n" % (mm.hexdigest(), rel_fn)
+		update(m, res)
+		if verbose:
+			sys.stdout.write(res)
+
+	return m.hexdigest()
+
+def hash_files(files):
+	# Compute recipe hash for a dict of (relative filename -> contents),
+	# the same way hash_recipe() would have for a directory with those files.
+	# (the filenames are prefixed with '/' so that the '/meta.yaml.template'
+	# test in hash_filelist works as it does for files on disk)
+	return hash_filelist([ '/' + fn for fn in files ], '/', open=lambda fn: contextlib.closing(StringIO(files[fn[1:]])))
+
+def hash_recipe(recipe_dir, verbose=False):
+	# Compute recipe hash for files in recipe_dir
+
+	# Get all files (incl. those in directories) and sort them
+	def listfiles(dir):
+		for root, directories, filenames in os.walk(dir):
+			for filename in filenames: 
+				yield os.path.join(root, filename)
+
+	filelist = list(listfiles(recipe_dir))
+	prefix = recipe_dir if recipe_dir.endswith('/') else recipe_dir + '/'
+
+	hash = hash_filelist(filelist, prefix, verbose=verbose)
+	if verbose:
+		print "result: ", hash
+	return hash
@@ -1,16 +1,23 @@
 import os
 import os.path
 import sys
-import tempfile
+import itertools
+import tarfile
+import contextlib
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
 import sqlalchemy
-from sqlalchemy import Column, Integer, String, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, Integer, Float, String, Boolean, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, backref
-from sqlalchemy.orm import sessionmaker, make_transient
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import bindparam
 
 from requests.exceptions import HTTPError
 
+from recipe import hash_filelist, hash_recipe
+
 # Have 'requests' actually be a session with the 'file://' adaptor mounted
 # so we can read local files as well.
 import requests
@@ -30,10 +37,27 @@ class Channel(Base):
 	# Relationship to Packages (in this Channel)
 	packages = relationship('Package', backref='channel', lazy='dynamic', cascade='all, delete, delete-orphan')
 
+	# Relationship to RepodataInfo (validators of the last indexed repodata.json)
+	repodata_info = relationship('RepodataInfo', uselist=False, cascade='all, delete, delete-orphan')
+
+class RepodataInfo(Base):
+	# Validators of the repodata.json last indexed from a channel. If the
+	# channel reports the same validators, we know it hasn't changed and
+	# skip reindexing it.
+	__tablename__ = 'repodata_info'
+
+	channel_id    = Column(Integer, ForeignKey('channels.id'), primary_key=True)
+
+	etag          = Column(String)			# HTTP ETag header
+	last_modified = Column(String)			# HTTP Last-Modified header
+	mtime         = Column(Float)			# file modification time (for file:// channels)
+
 class Package(Base):
 	__tablename__ = 'packages'
 	__table_args__ = (
 		UniqueConstraint('name', 'version', 'build_number', 'channel_id'),
+		Index('ix_packages_recipe_hash', 'name', 'version', 'recipe_hash', 'build_number'),	# covers RecipeDB.__getitem__
+		Index('ix_packages_channel_id', 'channel_id'),
 		{'sqlite_autoincrement': True}
 	)
 
@@ -45,11 +69,99 @@ class Package(Base):
 
 	recipe_hash  = Column(String)
 
+	filename     = Column(String)		# package filename, relative to <channel>/<platform>/
+
 	# Relationship to Channel
 	channel_id   = Column(Integer, ForeignKey('channels.id'))
 #	channel      = relationship("Channel", backref=backref("packages", order_by=id, lazy='dynamic'))
 	
 
+class Build(Base):
+	# A package build, recorded by the build scheduler. Used to estimate how
+	# long builds will take, and to report on where the build time goes.
+	__tablename__ = 'builds'
+	__table_args__ = (
+		Index('ix_builds_name_version', 'name', 'version'),
+		{'sqlite_autoincrement': True}
+	)
+
+	id           = Column(Integer, primary_key=True)
+
+	name         = Column(String)
+	version      = Column(String)
+	build_id     = Column(String)			# the manifest build ID (e.g., b1852), if known
+	success      = Column(Boolean, default=True)
+
+	duration     = Column(Float)			# wall clock time (seconds)
+	timestamp    = Column(Float)			# when the build finished (UNIX time)
+
+	cpu_user     = Column(Float)			# user CPU time (seconds)
+	cpu_sys      = Column(Float)			# system CPU time (seconds)
+	max_rss      = Column(Integer)			# peak resident set size of any process (bytes)
+	size         = Column(Integer)			# size of the built package (bytes)
+
+def add_column(table, column):
+	# Return a migration step adding a column to a table, unless it's already
+	# there (i.e., the table has just been created by create_all())
+	def add(conn):
+		if column.split()[0] not in [ row[1] for row in conn.execute('PRAGMA table_info(%s)' % table) ]:
+			conn.execute('ALTER TABLE %s ADD COLUMN %s' % (table, column))
+	return add
+
+# Database schema migrations. The schema version is stored in SQLite's
+# user_version pragma; entry i lists the statements (SQL, or functions of
+# the connection) that upgrade an existing database from version i to i+1.
+# New databases are created at the latest version by create_all().
+migrations = [
+	# 0 -> 1: indexes for recipe hash lookups and per-channel queries
+	[
+		'CREATE INDEX IF NOT EXISTS ix_packages_recipe_hash ON packages (name, version, recipe_hash, build_number)',
+		'CREATE INDEX IF NOT EXISTS ix_packages_channel_id ON packages (channel_id)',
+	],
+	# 1 -> 2: package filenames (forget the repodata validators, so all channels
+	# get rescanned and the filenames filled in)
+	[
+		add_column('packages', 'filename VARCHAR'),
+		'DELETE FROM repodata_info',
+	],
+	# 2 -> 3: resource usage of builds
+	[
+		add_column('builds', 'build_id VARCHAR'),
+		add_column('builds', 'success BOOLEAN DEFAULT 1'),
+		add_column('builds', 'cpu_user FLOAT'),
+		add_column('builds', 'cpu_sys FLOAT'),
+		add_column('builds', 'max_rss INTEGER'),
+		add_column('builds', 'size INTEGER'),
+	],
+	# 3 -> 4: packages whose recipe was missed by read_package_files (and got
+	# the hash of an empty file list); drop them and rescan all channels
+	[
+		"DELETE FROM packages WHERE recipe_hash = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'",
+		'DELETE FROM repodata_info',
+	],
+]
+
+def migrate(engine):
+	# Create the tables if they don't exist, and bring existing databases
+	# up to the current schema version
+	with engine.begin() as conn:
+		is_new = not engine.dialect.has_table(conn, Package.__tablename__)
+		Base.metadata.create_all(conn)
+
+		if is_new:
+			version = len(migrations)
+		else:
+			version = conn.execute('PRAGMA user_version').scalar()
+			for statements in migrations[version:]:
+				for statement in statements:
+					if callable(statement):
+						statement(conn)
+					else:
+						conn.execute(statement)
+				version += 1
+
+		conn.execute('PRAGMA user_version = %d' % version)
+
 # From http://stackoverflow.com/a/6078058/897575
 #   model: class to query or create
 #   kwargs: {member=value} dict of class members
@@ -63,15 +175,31 @@ def get_or_create(session, model, **kwargs):
 		session.commit()
 		return instance
 
+def _chunks(seq, n):
+	# Split seq into lists of at most n elements (e.g., to keep
+	# the number of SQL variables in an IN clause below SQLite's limit)
+	for i in xrange(0, len(seq), n):
+		yield seq[i:i+n]
+
 class RecipeDB(object):
 	server   = None
 	channel  = None
 
-	_db = None		# The loaded database (dict of dicts)
+	# The preloaded database, dict of (name, version) -> { recipe_hash -> build_number },
+	# the dict of (name, version) -> max(build_number), and the set of all known
+	# (name, version, build_number). Loaded on first use.
+	_db = None
+	_max_buildnum = None
+	_builds = None
+
+	jobs = 1		# Number of packages to download and hash in parallel when reindexing
+	commit_batch = 50	# Number of newly hashed packages to accumulate before committing
+
+	recipe_hashes_fn = 'recipe-hashes.json'	# The recipe hash index 'conda lsst upload' publishes next to repodata.json
 
-	def __init__(self, recipe_db_dir, platform):
-		self._db = {}
+	def __init__(self, recipe_db_dir, platform, jobs=1):
 		self.platform = platform
+		self.jobs = max(1, jobs)
 
 		# open the database, ensure the tables are defined
 		dbfn = os.path.join(recipe_db_dir, platform, 'cache-db.sqlite')
@@ -82,11 +210,15 @@ class RecipeDB(object):
 
 		##engine = sqlalchemy.create_engine('sqlite:///:memory:', echo=True)
 		engine = sqlalchemy.create_engine('sqlite:///%s' % dbfn, echo=False)
-		Base.metadata.create_all(engine)
+		migrate(engine)
 
 		# create a session
 		self._session = sessionmaker(bind=engine)()
 
+	def close(self):
+		self._session.close()
+		self._session.bind.dispose()
+
 	def get_repodata(self, urlbase):
 		# Fetch and parse repodate.json
 		urlbase = '%s%s/' % (urlbase, self.platform)
@@ -95,100 +227,122 @@ class RecipeDB(object):
 		r.raise_for_status()
 		return r.json()
 
-	def files_to_upload(self):
-		# FIXME: super-inefficient, loads the entire database to memory
-		remote_channels = [ channel.id for channel in self._session.query(Channel).filter(~Channel.urlbase.like('file://%')).all() ]
-
-		# Find packages that are present locally but not remotely
-		packages = self._session.query(Package).all()
-		all    = set([ (p.name, p.version, p.build_number) for p in packages ])
-		remote = set([ (p.name, p.version, p.build_number) for p in packages if p.channel_id in remote_channels ])
-
-		locals = [ p for p in packages if p.channel_id not in remote_channels ]
-		to_upload = [ p for p in locals if (p.name, p.version, p.build_number) in (all - remote) ]
-
-		# Find filenames
-		pkg2fn = dict()
-		for c in self._session.query(Channel).filter(Channel.urlbase.like('file://%')).all():
-			pkg2fn[p.channel.urlbase] = pkgs = dict()
-			base = os.path.join(p.channel.urlbase[len('file://'):], self.platform)
-			repodata = self.get_repodata(c.urlbase)
-			for fn, pkginfo in repodata[u'packages'].iteritems():
-				name, version, build_number = pkginfo['name'], pkginfo['version'], pkginfo['build_number']
-				assert (name, version, build_number) not in pkgs
-				pkgs[(name, version, build_number)] = os.path.join(base, fn)
-
-		filenames = [ pkg2fn[p.channel.urlbase][(p.name, p.version, p.build_number)] for p in to_upload ]
-		return filenames
-                                
-	def hash_filelist(self, filelist, ignore_prefix='', open=open, verbose=False):
-		import hashlib
-		m = hashlib.sha1()
-
-		if False:
-			# Echo the output to the screen
-			def update(m, s):
-				sys.stdout.write("%s" % s)
-				return m.update(s)
-		else:
-			def update(m, s): return m.update(s)
+	def get_repodata_if_modified(self, urlbase, info):
+		# Fetch and parse repodata.json, unless it hasn't changed since it was
+		# last fetched with validators stored in info (a RepodataInfo instance,
+		# or None).
+		#
+		# Returns (repodata, new_info), where repodata is None if unchanged.
+		urlbase = '%s%s/' % (urlbase, self.platform)
+		url = urlbase + 'repodata.json'
 
-		for fn in sorted(filelist):
-			# Ignore all files that *don't* end in the following suffixes
-			suffixes = [ '.patch', '.yaml', '.patch', '.diff', '.sh' ]	# FIXME: make this configurable somehow
-			for suffix in suffixes:
-				if fn.endswith(suffix):
-					break
+		# Local channels: compare the file modification times
+		if url.startswith('file://'):
+			try:
+				mtime = os.stat(url[len('file://'):]).st_mtime
+			except OSError:
+				mtime = None	# let requests report the error
+
+			if mtime is not None and info is not None and info.mtime == mtime:
+				return None, info
+
+			r = requests.get(url)
+			r.raise_for_status()
+			return r.json(), RepodataInfo(mtime=mtime)
+
+		# Remote channels: issue a conditional request
+		headers = {}
+		if info is not None:
+			if info.etag is not None:
+				headers['If-None-Match'] = info.etag
+			if info.last_modified is not None:
+				headers['If-Modified-Since'] = info.last_modified
+
+		r = requests.get(url, headers=headers)
+		if r.status_code == 304:
+			return None, info
+		r.raise_for_status()
 
-				# Special handling for meta.yaml, to work around the change introduced in conda-build 1.20.3
-				# https://github.com/conda/conda-build/commit/b4ec0e0659d8f376042d4fc391616bf235996cf5 where
-				# meta.yaml is now stored in the recipe dir as meta.yaml.template
-				if fn.endswith('/meta.yaml.template'):
-					break
-			else:
-				continue
-
-			mm = hashlib.sha1()
-			with open(fn) as fp:
-				rel_fn = fn[len(ignore_prefix):]
-
-				# Special handling for meta.yaml, to work around the change introduced in conda-build 1.20.3
-				# https://github.com/conda/conda-build/commit/b4ec0e0659d8f376042d4fc391616bf235996cf5 where
-				# meta.yaml is now stored in the recipe dir as meta.yaml.template
-				if rel_fn == 'meta.yaml.template':
-					rel_fn = 'meta.yaml'
-
-				# Special handling of some files:
-				if rel_fn == 'meta.yaml':
-					# remove build number and modify the build string from the meta.yaml file
-					# build:
-					#   number: 0
-					#   string: "blah_0"
-					state = 0	# 0: scan for build, 1: scan for number: 2: pass through the rest of the file
-					buildnum = None
-					for line in fp:
-						if state == 0 and line == 'build:\n':
-							state = 1
-						elif state == 1 and line.strip().startswith('number:'):
-							line = ''	# don't write out the build number
-						elif state == 1 and line.strip().startswith('string:'):
-							line = ''	# strip out the build string -- it encodes the buildnum as well
-									# FIXME: not sure what happens if we decide to change the buildstr prefix?
-						elif state == 1 and not line.strip():
-							state = 2	# didn't have an explicit number:
-
-						mm.update(line)
-				else:
-					# Just add the file contents
-					mm.update(fp.read())
-
-			# Update the list hash
-			res = "%s  %s\n" % (mm.hexdigest(), rel_fn)
-			update(m, res)
-			if verbose:
-				sys.stdout.write(res)
-
-		return m.hexdigest()
+		return r.json(), RepodataInfo(etag=r.headers.get('ETag'), last_modified=r.headers.get('Last-Modified'))
+
+	def get_recipe_hashes(self, urlbase):
+		# Fetch and parse the recipe hash index (recipe-hashes.json) of a
+		# channel. Returns a dict of filename -> ((name, version, build_number), recipe_hash),
+		# which is empty if the channel doesn't have an index (or it's unreadable).
+		url = '%s%s/%s' % (urlbase, self.platform, self.recipe_hashes_fn)
+		try:
+			r = requests.get(url)
+			r.raise_for_status()
+			packages = r.json()['packages']
+
+			index = {}
+			for filename, pkginfo in packages.iteritems():
+				name, version, recipe_hash = [ pkginfo[s].encode('utf-8') for s in ['name', 'version', 'recipe_hash'] ]
+				index[filename.encode('utf-8')] = (name, version, int(pkginfo['build_number'])), recipe_hash
+			return index
+		except (HTTPError, ValueError, KeyError, TypeError, AttributeError):
+			return {}
+
+	def make_recipe_hashes(self, urlbase, filenames=()):
+		# Return the recipe hash index (the contents of recipe-hashes.json) of
+		# the channel at urlbase, as it will be once the local packages in
+		# filenames (as returned by files_to_upload()) have been uploaded to it
+		packages = {}
+		def add(query):
+			for filename, name, version, build_number, recipe_hash in query:
+				if filename is not None and recipe_hash is not None:
+					packages[filename] = dict(name=name, version=version, build_number=build_number, recipe_hash=recipe_hash)
+
+		query = self._session.query(Package.filename, Package.name, Package.version, Package.build_number, Package.recipe_hash) \
+			.filter(Package.channel_id == Channel.id)
+		add(query.filter(Channel.urlbase == urlbase))
+		for chunk in _chunks(sorted(set(os.path.basename(fn) for fn in filenames)), 500):
+			add(query.filter(Channel.urlbase.like('file://%'), Package.filename.in_(chunk)))
+
+		return dict(info=dict(platform=self.platform), packages=packages)
+
+	def record_upload(self, urlbase, filenames):
+		# Add the local packages in filenames (as returned by files_to_upload()),
+		# which have just been uploaded to the channel at urlbase, to the cached
+		# index of that channel. This saves reindexing the channel (the next
+		# reindex will find them there already).
+		channel = get_or_create(self._session, Channel, urlbase=urlbase)
+		known = set(self._session.query(Package.name, Package.version, Package.build_number).filter(Package.channel_id == channel.id))
+
+		packages = {}
+		query = self._session.query(Package.name, Package.version, Package.build_number, Package.filename, Package.recipe_hash) \
+			.filter(Package.channel_id == Channel.id, Channel.urlbase.like('file://%'))
+		for chunk in _chunks(sorted(set(os.path.basename(fn) for fn in filenames)), 500):
+			for name, version, build_number, filename, recipe_hash in query.filter(Package.filename.in_(chunk)):
+				if (name, version, build_number) not in known:
+					packages[name, version, build_number] = (filename, recipe_hash)
+
+		self._add_packages(channel, [ (key, filename, recipe_hash) for key, (filename, recipe_hash) in packages.iteritems() ])
+		self._session.commit()
+
+		# Force a reload of the lookup tables
+		self._db = self._max_buildnum = self._builds = None
+
+	def files_to_upload(self):
+		# Return the filenames of packages that are present locally but not remotely
+		from sqlalchemy.orm import aliased
+		from sqlalchemy.sql import exists, and_
+
+		Remote, RemoteChannel = aliased(Package), aliased(Channel)
+		on_remote = exists().where(and_(
+			Remote.name == Package.name, Remote.version == Package.version, Remote.build_number == Package.build_number,
+			Remote.channel_id == RemoteChannel.id, ~RemoteChannel.urlbase.like('file://%')
+		))
+
+		query = self._session.query(Channel.urlbase, Package.name, Package.version, Package.build_number, Package.filename) \
+			.filter(Package.channel_id == Channel.id, Channel.urlbase.like('file://%'), ~on_remote)
+
+		filenames = []
+		for urlbase, name, version, build_number, filename in query:
+			if filename is None:
+				raise Exception("The filename of %s-%s-%s is unknown; refresh the package cache and try again." % (name, version, build_number))
+			filenames.append(os.path.join(urlbase[len('file://'):], self.platform, filename))
+		return filenames
 
 	def reindex(self, channels):
 		# Reindex the channels
@@ -206,13 +360,16 @@ class RecipeDB(object):
 
 		self._session.commit()
 
+		# Force a reload of the lookup tables
+		self._db = self._max_buildnum = self._builds = None
+
 	def reindex_channel(self, channel):
 		print "updating built package cache [from %s%s] " % (channel.urlbase, self.platform),
 
 		urlbase = '%s%s/' % (channel.urlbase, self.platform)
 
 		try:
-			repodata_ = self.get_repodata(channel.urlbase)
+			repodata_, repodata_info = self.get_repodata_if_modified(channel.urlbase, channel.repodata_info)
 		except HTTPError as e:
 			# Local channels may not exist if nothing has been built with conda-build yet
 			if channel.urlbase.startswith('file://'):
@@ -225,6 +382,10 @@ class RecipeDB(object):
 			else:
 				raise
 
+		if repodata_ is None:
+			print "  unchanged."
+			return
+
 		# convert to something more useful...
 		repodata = {}
 		for package, pkginfo in repodata_[u'packages'].iteritems():
@@ -232,105 +393,158 @@ class RecipeDB(object):
 			build_number = pkginfo['build_number']
 			repodata[(name, version, build_number)] = package
 
+		# Reconcile the cache with repodata in bulk, using one query for what
+		# we know about this channel, and one for what we know about the others
+		ours = dict(((name, version, build_number), (id, filename)) for (id, name, version, build_number, filename) in
+			self._session.query(Package.id, Package.name, Package.version, Package.build_number, Package.filename).filter(Package.channel_id == channel.id))
+		others = dict(((name, version, build_number), recipe_hash) for (name, version, build_number, recipe_hash) in
+			self._session.query(Package.name, Package.version, Package.build_number, Package.recipe_hash).filter(Package.channel_id != channel.id))
+
 		# Delete all cache entries that don't have a counterpart in repodata
 		# (e.g., files may have been deleted from the repository)
-		for package in channel.packages:
-			key = (package.name, package.version, package.build_number)
-			if key not in repodata:
-				#print "Would delete %s" % str(key)
-				self._session.delete(package)
-				sys.stdout.write("-")
-				sys.stdout.flush()
-
-		# Fetch each package, extract and hash its recipe
-		import tarfile
-		for (name, version, build_number), package in repodata.iteritems():
-			# Skip if we already know about this package
-			if channel.packages.filter(Package.name == name, Package.version == version, Package.build_number == build_number).count():
-				# print "already know about %s, skipping." % package
-				sys.stdout.write(".")
-				sys.stdout.flush()
-				continue
-
-			# See if we know about this package in other channels; just copy the info if we do
-			pkg = self._session.query(Package).filter_by(name=name, version=version, build_number=build_number).first()
-			if pkg is not None:
-				make_transient(pkg)
-				pkg.id = None
-				pkg.channel_id = channel.id
-				self._session.add(pkg)
-
-				sys.stdout.write("+")
-				sys.stdout.flush()
-				continue
-
-			pkgurl = urlbase + package
-			_, suffix = os.path.splitext(pkgurl)
+		deletes = [ id for key, (id, _) in ours.iteritems() if key not in repodata ]
+		for chunk in _chunks(deletes, 500):
+			self._session.query(Package).filter(Package.id.in_(chunk)).delete(synchronize_session=False)
+		sys.stdout.write("-" * len(deletes))
+
+		# Skip the packages we already know about (but make sure we have the right filenames)
+		renames = [ dict(_id=id, filename=repodata[key]) for key, (id, filename) in ours.iteritems() if key in repodata and filename != repodata[key] ]
+		if renames:
+			self._session.execute(Package.__table__.update().where(Package.id == bindparam('_id')).values(filename=bindparam('filename')), renames)
+		sys.stdout.write("." * sum(1 for key in repodata if key in ours))
+
+		# See if we know about the package in other channels; just copy the info if we do
+		copies = [ key for key in repodata if key not in ours and key in others ]
+		self._add_packages(channel, [ (key, repodata[key], others[key]) for key in copies ])
+		sys.stdout.write("+" * len(copies))
+		sys.stdout.flush()
 
-			# Download the package
-			with tempfile.NamedTemporaryFile(suffix=suffix) as fp:
-				#print os.path.basename(pkgurl)
-				download_url(pkgurl, fp)
-
-				# Extract the recipe
-				with tarfile.open(fp.name) as tf:
-					prefix = 'info/recipe/'
+		self._session.commit()
 
-					all = tf.getnames()
-					info = [ fn for fn in all if fn.startswith(prefix) ]
+		# The rest will have to be fetched, unless the channel publishes their
+		# recipe hashes (see make_recipe_hashes); take the ones it does from there
+		to_fetch = [ (key, package) for key, package in repodata.iteritems() if key not in ours and key not in others ]
+		if to_fetch and not channel.urlbase.startswith('file://'):
+			index = self.get_recipe_hashes(channel.urlbase)
+			indexed = [ (key, package, index[package][1]) for key, package in to_fetch if package in index and index[package][0] == key ]
+			self._add_packages(channel, indexed)
+			sys.stdout.write("+" * len(indexed))
+			sys.stdout.flush()
 
-					# hash all files in info/recipe/
-					import contextlib
-					hash = self.hash_filelist(info, prefix, open=lambda fn: contextlib.closing(tf.extractfile(fn)))
+			self._session.commit()
+			to_fetch = [ (key, package) for key, package in to_fetch if not (package in index and index[package][0] == key) ]
 
-					# add to the database
-					pkg = Package(name=name, version=version, build_number=build_number, recipe_hash=hash)
-					channel.packages.append(pkg)
+		# Fetch each remaining package, extract and hash its recipe. The downloads
+		# run in a pool of worker threads; this thread is the only one touching
+		# the session, and commits every commit_batch packages so an interrupted
+		# reindex loses at most one batch.
+		def fetch_and_hash(item):
+			key, package = item
+			return key, package, self.hash_package(urlbase + package)
 
-					try:
-						ctr += 1
-						if ctr == -1: break
-					except:
-						ctr = 0
+		pool = ThreadPool(self.jobs) if self.jobs > 1 else None
+		try:
+			results = pool.imap_unordered(fetch_and_hash, to_fetch) if pool is not None else itertools.imap(fetch_and_hash, to_fetch)
+			batch = []
+			for key, package, hash in results:
+				batch.append((key, package, hash))
 
 				sys.stdout.write("+")
 				sys.stdout.flush()
 
-			# write out the new database
-			self._session.commit()
+				# write out the new database
+				if len(batch) == self.commit_batch:
+					self._add_packages(channel, batch)
+					self._session.commit()
+					batch = []
+			self._add_packages(channel, batch)
+		finally:
+			if pool is not None:
+				pool.terminate()
+				pool.join()
+
+		# Remember what we've indexed, so we can skip it if it doesn't change
+		channel.repodata_info = repodata_info
 		self._session.commit()
 		print " done."
 
-	def hash_recipe(self, recipe_dir, verbose=False):
-		# Compute recipe hash for files in recipe_dir
+	def _add_packages(self, channel, packages):
+		# Bulk-insert a list of ((name, version, build_number), filename, recipe_hash) into channel
+		if not packages:
+			return
+
+		rows = [ dict(name=name, version=version, build_number=build_number, filename=filename, recipe_hash=recipe_hash, channel_id=channel.id)
+				for (name, version, build_number), filename, recipe_hash in packages ]
+		self._session.execute(Package.__table__.insert(), rows)
+
+	def hash_package(self, pkgurl):
+		# Return the hash of the recipe stored in the package at pkgurl.
+		# Note: called from worker threads; must not touch the session.
+		# Returns None if the package has no recipe (the hash of an empty file
+		# list would match any other recipe-less package).
+		prefix = 'info/recipe/'
+		recipe = read_package_files(pkgurl, prefix)
+		if not recipe:
+			return None
+
+		# hash all files in info/recipe/
+		return hash_filelist(recipe.keys(), prefix, open=lambda fn: contextlib.closing(StringIO(recipe[fn])))
+
+	def _load(self):
+		# Load the (name, version, recipe_hash) -> build_number lookup tables
+		# with a single query, so that recipe generation doesn't need to
+		# hit the database for every product.
+		if self._db is not None:
+			return
+
+		self._db, self._max_buildnum, self._builds = {}, {}, set()
+		query = self._session.query(Package.name, Package.version, Package.recipe_hash, Package.build_number).order_by(Package.id)
+		for name, version, recipe_hash, build_number in query:
+			key = (name, version)
+			self._db.setdefault(key, {}).setdefault(recipe_hash, build_number)
+			self._max_buildnum[key] = max(build_number, self._max_buildnum.get(key, build_number))
+			self._builds.add((name, version, build_number))
+
+	def record_build(self, name, version, **usage):
+		# Record a build of package name-version. usage are the remaining
+		# Build columns (success, duration, cpu_user, ...)
+		import time
+		self._session.add(Build(name=name, version=version, timestamp=time.time(), **usage))
+		self._session.commit()
 
-		# Get all files (incl. those in directories) and sort them
-		def listfiles(dir):
-			for root, directories, filenames in os.walk(dir):
-				for filename in filenames: 
-					yield os.path.join(root, filename)
+	def get_builds(self):
+		# Return all recorded builds, oldest first
+		return self._session.query(Build).order_by(Build.timestamp).all()
 
-		filelist = list(listfiles(recipe_dir))
-		prefix = recipe_dir if recipe_dir.endswith('/') else recipe_dir + '/'
+	def estimate_build_times(self, packages):
+		# Estimate the build times of a list of (name, version) packages, from
+		# the most recent build of the same version (or, failing that, of any
+		# version) of each package. Packages that have never been built are
+		# assumed to take as long as the median one.
+		by_version, by_name = {}, {}
+		for name, version, duration in self._session.query(Build.name, Build.version, Build.duration).filter(Build.success == True).order_by(Build.timestamp):
+			by_version[name, version] = by_name[name] = duration
 
-		hash = self.hash_filelist(filelist, prefix, verbose=verbose)
-		if verbose:
-			print "result: ", hash
-		return hash
+		known = sorted(by_name.values())
+		typical = known[len(known) // 2] if known else 1.
+		return dict(((name, version), by_version.get((name, version), by_name.get(name, typical))) for name, version in packages)
 
 	def get_next_buildnum(self, name, version):
-		from sqlalchemy.sql import func
-		max = self._session.query(func.max(Package.build_number)).filter(Package.name == name, Package.version == version).scalar()
+		self._load()
+		max = self._max_buildnum.get((name, version))
 		return max + 1 if max is not None else 0
 
+	def has_build(self, name, version, build_number):
+		# Is there a package name-version with this build number on any channel?
+		self._load()
+		return (name, version, build_number) in self._builds
+
 	def __getitem__(self, key):
 		# Return buildnum for (name, version, recipe_hash) if in the database
 		name, version, recipe_hash = key
-		package = self._session.query(Package).filter_by(name=name, version=version, recipe_hash=recipe_hash).first()
-		if package is None:
-			raise KeyError()
-		else:
-			return package.build_number
+
+		self._load()
+		return self._db.get((name, version), {})[recipe_hash]
 
 # Cribbed from http://stackoverflow.com/questions/16694907/how-to-download-large-file-in-python-with-requests-py
 def download_url(url, fp):
@@ -343,6 +557,37 @@ def download_url(url, fp):
 			fp.write(chunk)
 	fp.flush()
 
+def read_package_files(url, prefix):
+	# Return a dict of (filename -> contents) for all files under prefix
+	# in the package at url.
+	#
+	# The package is read as a stream and never written to disk. Conda-build
+	# stores the tarball members in sorted order, so the info/ section comes
+	# before the (potentially huge) opt/ payload of LSST packages; we stop
+	# reading as soon as we're past prefix. Packages not built that way may
+	# have their info/ members anywhere, so we only stop early if we've seen
+	# something under prefix and the members have been in order so far
+	# (otherwise the whole tarball is read).
+	files = {}
+	with contextlib.closing(requests.get(url, stream=True)) as r:
+		r.raise_for_status()
+		if hasattr(r.raw, 'decode_content'):
+			r.raw.decode_content = True
+
+		with tarfile.open(fileobj=r.raw, mode='r|*') as tf:
+			last, ordered = '', True
+			for ti in tf:
+				ordered = ordered and ti.name >= last
+				last = ti.name
+
+				if ti.name.startswith(prefix):
+					if ti.isfile():
+						files[ti.name] = tf.extractfile(ti).read()
+				elif files and ordered and ti.name > prefix:
+					break
+
+	return files
+
 def test_release_db():
 	db = RecipeDB()
 
@@ -350,7 +595,7 @@ def test_release_db():
 	dir = 'recipes/static/eups'
 	#name, version = "lsst-palpy", "1.6.0002"
 	#dir = 'recipes/generated/lsst-palpy'
-	hash = db.hash_recipe(dir)
+	hash = hash_recipe(dir)
 	print "hash for %s: %s" % (dir, hash)
 #	exit()
 
@@ -1,10 +1,12 @@
 import os, os.path, shutil, subprocess, re, sys, glob, tempfile, contextlib, fnmatch
 from collections import OrderedDict, namedtuple
-from version_maker import eups_to_conda_version
-from utils import fill_out_template, create_yaml_list
+from version_maker import eups_to_conda_version, branch_sha1, GitTimestampResolver
+from utils import render_template, fill_template, create_yaml_list, touch, write_if_changed
+from recipe import Recipe, hash_files
+from artifact_store import ArtifactStore
 import json
 
-ProductInfo = namedtuple('ProductInfo', ['conda_name', 'version', 'build_string', 'buildnum', 'product', 'eups_version', 'is_built', 'is_ours'])
+ProductInfo = namedtuple('ProductInfo', ['conda_name', 'version', 'build_string', 'buildnum', 'product', 'eups_version', 'is_built', 'is_ours', 'deps'])
 
 class RecipeMaker(object):
 	def __init__(self, config, root_dir, db):
@@ -13,6 +15,15 @@ class RecipeMaker(object):
 		self.db = db
 
 		self.products = OrderedDict()	# A mapping from conda_name -> ProductInfo instance
+		self.recipes = {}		# A mapping from conda_name -> Recipe instance
+
+		# Commit timestamps, for versioning products with <branch>-g<sha1> EUPS versions
+		self.git = GitTimestampResolver(os.path.join(root_dir, 'repo-cache'), jobs=config.git_jobs, timeout=config.git_timeout)
+		self.timestamps = {}		# A mapping from (giturl, sha1) -> timestamp, filled in by generate()
+
+		# Previously built packages, that can be reused even if they're not on any channel
+		self.artifacts = ArtifactStore(config.recipe_db_dir, config.platform, config.artifact_store_size) if config.artifact_store_size else None
+		self.checkouts = []		# The packages taken from the artifact store by get_build_info()
 
 	def report_progress(self, product, verstr = None):
 		if verstr is not None:
@@ -29,7 +40,7 @@ class RecipeMaker(object):
 		else:
 			return conda_name
 
-	def prepare_patches(self, product, dir):
+	def prepare_patches(self, product, recipe):
 		patch_dir = os.path.join(self.config.patch_dir, product)
 		if not os.path.isdir(patch_dir):
 			return ''
@@ -37,7 +48,8 @@ class RecipeMaker(object):
 		patch_files = glob.glob(os.path.join(patch_dir, '*.patch'))
 
 		for patchfn in patch_files:
-			shutil.copy2(patchfn, dir)
+			with open(patchfn, 'rb') as fp:
+				recipe.files[os.path.basename(patchfn)] = fp.read()
 	
 		# convert to meta.yaml string
 		patchlist = [ os.path.basename(p) for p in patch_files ]
@@ -49,7 +61,7 @@ class RecipeMaker(object):
 		conda_name = self.config.conda_name_for(product)
 
 		# convert to conda version
-		version, build_string_prefix, buildnum, compliant = eups_to_conda_version(product, eups_version, giturl)
+		version, build_string_prefix, buildnum, compliant = eups_to_conda_version(product, eups_version, giturl, self.timestamps)
 
 		# warn if the version is not compliant
 		problem = "" if compliant else " [WARNING: version format incompatible with conda]"
@@ -96,14 +108,16 @@ class RecipeMaker(object):
 
 		bdeps, rdeps = sorted(bdeps), sorted(rdeps)	# sort, so the ordering is predicatble in meta.yaml
 
+		# the products we're generating recipes for that this one depends on (for the build scheduler)
+		deps = sorted(set(p.split()[0] for p in bdeps + rdeps) & set(self.products))
+
 		#
-		# Create the Conda packaging spec files
+		# Create the Conda packaging spec files (in memory; they're written out by generate())
 		#
-		dir = os.path.join(self.config.output_dir, conda_name)
-		os.makedirs(dir)
+		recipe = Recipe()
 
-		# Copy any patches into the recipe dir
-		patches = self.prepare_patches(product, dir)
+		# Copy any patches into the recipe
+		patches = self.prepare_patches(product, recipe)
 
 		# build.sh (TBD: use exact eups versions, instead of -r .)
 		setups = []
@@ -113,14 +127,14 @@ class RecipeMaker(object):
 		template_dir = self.config.template_dir
 
 		build_template = 'build.sh.template' if product not in self.config.internal_products else 'build-internal.sh.template'
-		fill_out_template(os.path.join(dir, 'build.sh'), os.path.join(template_dir, build_template),
+		recipe.files['build.sh'] = render_template(os.path.join(template_dir, build_template),
 			setups = setups,
 			eups_version = eups_version,
 			eups_tags = ' '.join(self.config.global_eups_tags)
 		)
 
 		# pre-link.sh (to add the global tags)
-		fill_out_template(os.path.join(dir, 'pre-link.sh'), os.path.join(template_dir, 'pre-link.sh.template'),
+		recipe.files['pre-link.sh'] = render_template(os.path.join(template_dir, 'pre-link.sh.template'),
 			product = product,
 		)
 
@@ -130,8 +144,7 @@ class RecipeMaker(object):
 		reqstr_r = create_yaml_list(rdeps)
 		reqstr_b = create_yaml_list(bdeps)
 
-		meta_yaml = os.path.join(dir, 'meta.yaml')
-		fill_out_template(meta_yaml, os.path.join(template_dir, 'meta.yaml.template'),
+		recipe.files['meta.yaml'] = render_template(os.path.join(template_dir, 'meta.yaml.template'),
 			productNameLowercase = conda_name.lower(),
 			version = version,
 			gitrev = sha,
@@ -145,30 +158,72 @@ class RecipeMaker(object):
 		# Find our build number. If this package already exists in the release DB,
 		# re-use the build number and mark it as '.done' so it doesn't get rebuilt.
 		# Otherwise, increment the max build number by one and use that.
-		buildnum, build_string, is_built = self.get_build_info(conda_name.lower(), version, dir, build_string_prefix)
+		buildnum, build_string, is_built = self.get_build_info(conda_name.lower(), version, recipe, build_string_prefix)
 
 		# Fill in the build number and string
-		fill_out_template(meta_yaml, meta_yaml,
+		recipe.files['meta.yaml'] = fill_template(recipe.files['meta.yaml'],
 			buildnum = buildnum,
 			build_string = build_string
 		)
+		self.recipes[conda_name] = recipe
 
 		# record we've seen this product
-		self.products[conda_name] = ProductInfo(conda_name, version, build_string, buildnum, product, eups_version, is_built, True)
+		self.products[conda_name] = ProductInfo(conda_name, version, build_string, buildnum, product, eups_version, is_built, True, deps)
 
-	def get_build_info(self, conda_name, version, recipe_dir, build_string_prefix):
+	def get_build_info(self, conda_name, version, recipe, build_string_prefix):
 		is_built = False
-		hash = self.db.hash_recipe(recipe_dir)
+		hash = hash_files(recipe.files)
 		try:
 			buildnum = self.db[conda_name, version, hash]
 			is_built = True
 		except KeyError:
 			buildnum = self.db.get_next_buildnum(conda_name, version)
 
+			# It may have been built before without making it to a channel; if
+			# so, take the package from the artifact store (unless its build
+			# number has since been taken by a different build on some channel)
+			info = self.artifacts.get(hash) if self.artifacts is not None else None
+			if info is not None and (info['name'], info['version']) == (conda_name, version) and not self.db.has_build(conda_name, version, info['build_number']):
+				build_string = '%s_%s' % (build_string_prefix, info['build_number']) if build_string_prefix else str(info['build_number'])
+				if info['filename'] == '%s-%s-%s.tar.bz2' % (conda_name, version, build_string):
+					path = self.artifacts.checkout(hash, os.path.join(self.config.croot, self.config.platform))
+					if path is not None:
+						self.checkouts.append(path)
+						buildnum, is_built = info['build_number'], True
+
 		build_string = '%s_%s' % (build_string_prefix, buildnum) if build_string_prefix else str(buildnum)
 
 		return buildnum, build_string, is_built
 
+	def get_static_build_info(self, name, version, meta, recipe):
+		# The build number of a static recipe. As for generated recipes, re-use
+		# the build number of an identical recipe that's already been built
+		# (looking for the recipe as it is, and as it would be once we've set the
+		# build number in it), or a package built with the build number given in
+		# meta.yaml. Otherwise, take the next free build number, and set it in
+		# the recipe's meta.yaml.
+		number = int((meta.get('build') or {}).get('number', 0))
+
+		numbered = Recipe(recipe.files)
+		numbered.set_build_number(number)
+
+		for r in [ recipe, numbered ]:
+			try:
+				buildnum, is_built = self.db[name, version, hash_files(r.files)], True
+				break
+			except KeyError:
+				pass
+		else:
+			if self.db.has_build(name, version, number):
+				buildnum, is_built = number, True
+			else:
+				buildnum, is_built = max(number, self.db.get_next_buildnum(name, version)), False
+
+		if buildnum != number:
+			recipe.set_build_number(buildnum)
+
+		return buildnum, is_built
+
 	##################################
 	# Use static recipes to satisfy dependencies
 	#
@@ -182,61 +237,42 @@ class RecipeMaker(object):
 		# Now recursively copy the recipe, and all others it depends on
 		def _copy_recipe(name):
 			src = os.path.join(additional_recipes_dir, name)
-			dest = os.path.join(self.config.output_dir, name)
-			if os.path.isdir(dest):
+			if name in self.recipes:
 				# Already copied
 				return
 
 			# copy the additional recipe
-			shutil.copytree(src, dest)
+			self.recipes[name] = recipe = Recipe.from_dir(src)
 
 			# copy all its dependencies for which we have the recipes
 			import yaml
-			meta = yaml.load(open(os.path.join(src, 'meta.yaml')))
+			meta = yaml.load(recipe.files['meta.yaml'])
+			deps = set()
 			for kind in ['run', 'build']:
 				if kind in meta.get('requirements', {}):
 					for dep in meta['requirements'][kind]:
+						dep = dep.split()[0]
 						if _have_recipe(dep):
 							_copy_recipe(dep)
+							deps.add(dep)
 
 			# add to list of products, and decide if we need to rebuild it
 			assert name not in self.products
 
-			# Load name+version from meta.yaml
-			import yaml
-			with open(os.path.join(dest, 'meta.yaml')) as fp:	# FIXME: meta.yaml configs are not true .yaml files; this may fail in the future
-				meta = yaml.load(fp)
+			# Load name+version from meta.yaml (FIXME: meta.yaml configs are not true .yaml files; this may fail in the future)
 			assert meta['package']['name'] == name, "meta['package']['name'] != name :::: (%s, %s)" % (meta['package']['name'], name)
 
 			#
-			# Check if this package has already been built, by looking for a built
-			# package with the same name, version and build number
+			# Check if this package has already been built (using the recipe
+			# database, which indexes the local conda-bld/<platform> channel as well
+			# as the remote ones), and find its build number
 			#
-			version = meta['package']['version']
-			buildnum = 0
-			build_string = "py27_0"
-			if 'build' in meta:
-				buildnum     = meta['build'].get('number', buildnum)
-				build_string = meta['build'].get('number', build_string)
-			try:
-				ret = subprocess.check_output('conda search --use-local --spec --json %s=%s' % (name, version), shell=True).strip()
-				j = json.loads(ret)
-				for pkginfo in j.get(unicode(name), []):
-					if pkginfo[u'build_number'] == buildnum:
-						is_built = True
-						break
-				else:
-					is_built = False
-			except subprocess.CalledProcessError as e:
-				# it's OK to fail on an uninitialized conda-bld/<platform> directory.
-				# TODO: the way we test for this is pretty ugly, but I can't think of a better way yet
-				j = json.loads(e.output)
-				if (j[u'error_type'] == 'NoPackagesFound') or (j[u'error_type'] == "RuntimeError" and j[u'error'].startswith("Could not find URL: file:///")):
-					is_built = False
-				else:
-					raise
-
-			self.products[name] = ProductInfo(name, version, build_string, buildnum, None, None, is_built, False)
+			version = str(meta['package']['version'])
+			buildnum, is_built = self.get_static_build_info(name, version, meta, recipe)
+			meta = yaml.load(recipe.files['meta.yaml'])	# (the build number may have changed)
+			build_string = str((meta.get('build') or {}).get('string', 'py27_%d' % buildnum))
+
+			self.products[name] = ProductInfo(name, version, build_string, buildnum, None, None, is_built, False, sorted(deps))
 
 			self.report_progress(name, self.products[name].version)
 
@@ -261,10 +297,55 @@ class RecipeMaker(object):
 
 		return deps_['build'], deps_['run']
 
-	def generate(self, manifest):
+	def index_checkouts(self):
+		# Add the packages checked out of the artifact store into conda-bld/<platform>
+		# to its repodata.json, so that the builds of their dependents find them
+		from uploader import Uploader, package_info
+
+		dir = os.path.join(self.config.croot, self.config.platform)
+		packages = dict((os.path.basename(path), package_info(path)) for path in self.checkouts)
+		if not Uploader(None, dir).update_repodata(packages):
+			subprocess.check_call(['conda', 'index', dir])
+
+	def update_recipe(self, name):
+		# Write the recipe for name into output_dir, unless an identical one is
+		# already there. Returns True if the recipe was (re)written.
+		recipe = self.recipes[name]
+		dest = os.path.join(self.config.output_dir, name)
+		if os.path.isdir(dest):
+			# ignore the markers and logs generate() and rebuild.sh put in
+			# there (the top level files beginning with '.' or '_')
+			existing = Recipe.from_dir(dest, ignore=lambda fn: fn[0] in '._' and os.sep not in fn)
+			if existing.digest() == recipe.digest():
+				return False
+
+		shutil.rmtree(dest, ignore_errors=True)
+		recipe.write(dest)
+		return True
+
+	def generate(self, manifest, build_id=None, clean=False):
 		# Generate conda package files and build driver script
-		shutil.rmtree(self.config.output_dir, ignore_errors=True)
-		os.makedirs(self.config.output_dir)
+		#
+		# Unless clean=True, the recipes already in output_dir are updated
+		# incrementally: unchanged recipes (with their build logs) are left
+		# alone, and the recipes of products no longer in the manifest are
+		# removed. The .done markers are kept in step with whether each
+		# package has been built.
+		if clean:
+			shutil.rmtree(self.config.output_dir, ignore_errors=True)
+		if not os.path.isdir(self.config.output_dir):
+			os.makedirs(self.config.output_dir)
+
+		# Look up the commit timestamps needed to version the products, all at
+		# once (refreshing the git mirrors in parallel, as needed)
+		commits = [ (self.config.get_giturl(product), branch_sha1(version))
+				for (product, sha, version, deps) in manifest.itervalues()
+				if product not in self.config.skip_products and branch_sha1(version) is not None ]
+		if commits:
+			print "resolving commit timestamps for %d product(s)..." % len(commits)
+			sys.stdout.flush()
+			self.timestamps = self.git.resolve(commits)
+
 		print "generating recipes: "
 		for (product, sha, version, deps) in manifest.itervalues():
 			if product in self.config.skip_products: continue
@@ -278,33 +359,56 @@ class RecipeMaker(object):
 			self.gen_conda_package(product, sha, version, giturl, deps)
 		print "done."
 
+		# Add the packages taken from the artifact store to the local channel's index
+		if self.checkouts:
+			print "reusing %d package(s) from the artifact store." % len(self.checkouts)
+			self.index_checkouts()
+
+		# Write out the new and changed recipes, remove the ones we no longer need
+		updated = [ name for name in self.products if self.update_recipe(name) ]
+		removed = [ name for name in os.listdir(self.config.output_dir)
+				if name not in self.products and name[0] != '.' and os.path.isdir(os.path.join(self.config.output_dir, name)) ]
+		for name in removed:
+			shutil.rmtree(os.path.join(self.config.output_dir, name))
+		print "recipes: %d new or changed, %d unchanged, %d removed." % (len(updated), len(self.products) - len(updated), len(removed))
+
 		#
-		# write out the rebuild script for packages that need rebuilding
+		# write out the rebuild script (and the build plan) for packages that need rebuilding
 		#
-		rebuilds = []
+		rebuilds, plan = [], []
 		print "generating rebuild script:"
 		for pi in self.products.itervalues():
 			conda_version = "%s-%s" % (pi.version, pi.build_string)
 
 			rebuilds.append("rebuild %s %s %s %s" % (pi.conda_name, conda_version, pi.product, pi.eups_version))
+			plan.append(dict(name=pi.conda_name, version=pi.version, build_string=pi.build_string, product=pi.product, eups_version=pi.eups_version, deps=pi.deps))
+			recipe_dir = os.path.join(self.config.output_dir, pi.conda_name)
 			if not pi.is_built:
+				if os.path.exists(os.path.join(recipe_dir, '.done')):
+					os.unlink(os.path.join(recipe_dir, '.done'))	# left over from an earlier build whose package is gone
 				print "  will build:    %s-%s" % (pi.conda_name, conda_version)
 			else:
-				with open(os.path.join(self.config.output_dir, pi.conda_name, '.done'), 'w'):	# create the .done marker file
-					pass
+				touch(os.path.join(recipe_dir, '.done'))	# create the .done marker file
 				print "  already built: %s-%s" % (pi.conda_name, conda_version)
 
-			if pi.conda_name in self.config.skip_build:
-				# create the .skip.$PLATFORM marker files
-				for platform in self.config.skip_build[pi.conda_name]:
-					with open(os.path.join(self.config.output_dir, pi.conda_name, '.skip.'+platform), 'w'):
-						pass
-				print "    (builds will always be skipped on %s)" % ', '.join(self.config.skip_build[pi.conda_name])
+			# create the .skip.$PLATFORM marker files (and remove the stale ones)
+			skip_platforms = self.config.skip_build.get(pi.conda_name, [])
+			for fn in glob.glob(os.path.join(recipe_dir, '.skip.*')):
+				if fn[len(os.path.join(recipe_dir, '.skip.')):] not in skip_platforms:
+					os.unlink(fn)
+			for platform in skip_platforms:
+				touch(os.path.join(recipe_dir, '.skip.'+platform))
+			if skip_platforms:
+				print "    (builds will always be skipped on %s)" % ', '.join(skip_platforms)
 
 		print "done."
 
-		fill_out_template(os.path.join(self.config.output_dir, 'rebuild.sh'), os.path.join(self.config.template_dir, 'rebuild.sh.template'),
+		write_if_changed(os.path.join(self.config.output_dir, 'rebuild.sh'), render_template(os.path.join(self.config.template_dir, 'rebuild.sh.template'),
 			output_dir = self.config.output_dir,
 			rebuilds = '\n'.join(rebuilds)
-			)
+			))
+
+		# The build plan: rebuild.sh's package list with the dependency graph, used by
+		# the parallel build scheduler (see builder.py)
+		write_if_changed(os.path.join(self.config.output_dir, 'build-plan.json'), json.dumps(dict(build_id=build_id, packages=plan), indent=1))
 
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+from builder import format_duration
+
+def format_size(nbytes):
+	# Format a size in bytes in human-readable form
+	if nbytes is None:
+		return '-'
+	for unit in ['B', 'K', 'M', 'G']:
+		if nbytes < 1024 or unit == 'G':
+			break
+		nbytes /= 1024.
+	return ("%d%s" if unit == 'B' else "%.1f%s") % (nbytes, unit)
+
+def report_builds(db, top=10, threshold=0.2):
+	# Print a report on the builds recorded by the build scheduler: the
+	# slowest and heaviest packages, the totals for each build tag, and the
+	# packages whose build time went up by more than `threshold` (a fraction)
+	# since their previous build.
+	builds = [ b for b in db.get_builds() if b.success ]
+	if not builds:
+		print "no builds have been recorded yet."
+		return
+
+	# The most recent build of each package
+	latest = OrderedDict()
+	for b in builds:
+		latest[b.name] = b
+
+	def table(title, rows):
+		print title
+		print "  %-40s %-24s %9s %9s %9s %9s" % ('package', 'version', 'wall', 'cpu', 'peak RSS', 'size')
+		for b in rows:
+			print "  %-40s %-24s %9s %9s %9s %9s" % (b.name, b.version, format_duration(b.duration),
+				format_duration((b.cpu_user or 0) + (b.cpu_sys or 0)), format_size(b.max_rss), format_size(b.size))
+		print
+
+	table("slowest packages:", sorted(latest.values(), key=lambda b: -b.duration)[:top])
+	table("heaviest packages (peak memory):", sorted(latest.values(), key=lambda b: -(b.max_rss or 0))[:top])
+
+	# Totals per build tag, in the order the tags were first built
+	tags = OrderedDict()
+	for b in builds:
+		tags.setdefault(b.build_id, []).append(b)
+
+	print "builds by build tag:"
+	print "  %-16s %9s %11s %11s %9s" % ('tag', 'packages', 'wall', 'cpu', 'peak RSS')
+	for tag, bs in tags.iteritems():
+		print "  %-16s %9d %11s %11s %9s" % (tag or '(unknown)', len(bs), format_duration(sum(b.duration for b in bs)),
+			format_duration(sum((b.cpu_user or 0) + (b.cpu_sys or 0) for b in bs)), format_size(max(b.max_rss for b in bs)))
+	print
+
+	# Regressions: compare each package's most recent build with the one before it
+	previous = {}
+	regressions = []
+	for b in builds:
+		prev = previous.get(b.name)
+		if prev is not None and b.duration > prev.duration * (1 + threshold):
+			regressions.append((prev, b))
+		previous[b.name] = b
+	regressions = [ (prev, b) for (prev, b) in regressions if latest[b.name] is b ]
+
+	print "regressions (more than %d%% slower than the previous build):" % (threshold * 100)
+	if not regressions:
+		print "  none."
+	for prev, b in sorted(regressions, key=lambda (prev, b): prev.duration - b.duration):
+		print "  %-40s %s -> %s (+%d%%)   [%s %s -> %s %s]" % (b.name, format_duration(prev.duration), format_duration(b.duration),
+			(b.duration / prev.duration - 1) * 100 if prev.duration else 0, prev.build_id or '?', prev.version, b.build_id or '?', b.version)
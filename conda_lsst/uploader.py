@@ -0,0 +1,278 @@
+import os, os.path, sys, json, subprocess, threading, tempfile, shutil, hashlib, pipes
+from multiprocessing.pool import ThreadPool
+
+class Uploader(object):
+	#
+	# Uploads packages to a channel directory on a remote server, over SSH.
+	#
+	# All commands run over a single (multiplexed) SSH connection, which is
+	# opened when the Uploader is created and closed by close(). Up to `jobs`
+	# files are transferred at the same time.
+	#
+	# Each file is streamed into <name>.part on the server, which is checked
+	# against the md5 and size of the package (from the repodata.json of its
+	# local channel, if it's listed there) and only then moved into place. An
+	# interrupted upload leaves the .part file behind, and the next upload
+	# resumes from where it stopped; files that are already on the server
+	# (with the right checksum) are not uploaded again.
+	#
+	# The remote commands stick to what POSIX shells and utilities provide
+	# (plus md5sum, or md5 on BSD/macOS), so the server needn't run Linux.
+	#
+	# If server is None, the "remote" directory is a local one (the commands
+	# run in a local shell); useful for testing.
+	#
+	retries = 1		# Number of times to restart an upload that failed verification
+	chunk_size = 1024*1024
+	control_persist = 60	# Seconds the master connection outlives its last use (should close() never run)
+
+	def __init__(self, server, dir, jobs=1, ssh='ssh'):
+		self.server = server
+		self.dir = dir
+		self.jobs = max(1, jobs)
+		self.ssh = ssh
+
+		self._lock = threading.Lock()	# serializes progress output
+		self._control_dir = None
+
+		if server is not None:
+			# Start the master connection (which the commands below share)
+			self._control_dir = tempfile.mkdtemp(prefix='conda-lsst-ssh-')
+			with open(os.devnull, 'r+') as devnull:
+				if subprocess.call(self._ssh_args('-o', 'ControlMaster=yes', '-o', 'ControlPersist=%d' % self.control_persist, '-n', '-N', '-f'),
+						stdin=devnull, stdout=devnull):
+					self.close()
+					raise Exception("Failed to connect to %s" % server)
+
+		try:
+			self.run('mkdir -p %s' % self._path())
+		except:
+			self.close()
+			raise
+
+	def _path(self, fn=None):
+		# The quoted path to fn in dir, for use in remote commands (leaving a
+		# leading ~/ unquoted, so it's still expanded)
+		path = os.path.join(self.dir, fn) if fn is not None else self.dir
+		if path.startswith('~/'):
+			return '~/' + pipes.quote(path[2:])
+		return pipes.quote(path)
+
+	def _ssh_args(self, *opts):
+		return [ self.ssh, '-o', 'ControlPath=%s' % os.path.join(self._control_dir, 'master') ] + list(opts) + [ self.server ]
+
+	def ssh_command(self):
+		# The ssh command line (as a string) that runs commands over our
+		# connection, e.g. for rsync's -e option
+		if self.server is None:
+			raise Exception("Not connected to a server")
+		return ' '.join(pipes.quote(arg) for arg in self._ssh_args('-o', 'ControlMaster=no')[:-1])
+
+	def _args(self, cmd):
+		# The command line to run the shell command cmd on the server
+		if self.server is None:
+			return [ 'sh', '-c', cmd ]
+		return self._ssh_args('-o', 'ControlMaster=no') + [ cmd ]
+
+	def close(self):
+		if self._control_dir is None:
+			return
+
+		with open(os.devnull, 'w') as devnull:
+			subprocess.call(self._ssh_args('-O', 'exit'), stdout=devnull, stderr=devnull)
+		shutil.rmtree(self._control_dir, ignore_errors=True)
+		self._control_dir = None
+
+	def run(self, cmd, stdin=None, check=True, tty=False):
+		# Run the shell command cmd on the server, returning its output (unless
+		# tty=True, in which case it goes straight to the terminal). If stdin
+		# is given, it's a file-like object whose contents (from its current
+		# position) are passed to the command.
+		args = self._args(cmd)
+		if tty and self.server is not None:
+			args[1:1] = [ '-qt' ]
+		proc = subprocess.Popen(args, stdin=subprocess.PIPE if stdin is not None else None, stdout=None if tty else subprocess.PIPE)
+		if stdin is not None:
+			try:
+				for chunk in iter(lambda: stdin.read(self.chunk_size), ''):
+					proc.stdin.write(chunk)
+			finally:
+				proc.stdin.close()
+		out = proc.stdout.read() if not tty else None
+		if proc.wait() and check:
+			raise subprocess.CalledProcessError(proc.returncode, cmd)
+		return out if check else (proc.returncode, out)
+
+	def write_file(self, fn, data):
+		# Atomically replace the file fn (relative to dir) with data
+		from cStringIO import StringIO
+		path = self._path(fn)
+		self.run('cat > {path}.tmp && mv -f {path}.tmp {path}'.format(path=path), stdin=StringIO(data))
+
+	def remote_files(self):
+		# Return a dict of filename -> size for the files in dir
+		out = self.run('cd %s && LC_ALL=C ls -ln' % self._path())
+		files = {}
+		for line in out.splitlines():
+			if line.startswith('-'):	# regular files
+				fields = line.split(None, 8)
+				files[fields[8]] = int(fields[4])
+		return files
+
+	def _progress(self, msg):
+		with self._lock:
+			print msg
+			sys.stdout.flush()
+
+	def upload(self, files):
+		# Upload the (local) files into dir. Returns the list of the filenames
+		# (basenames) that are now on the server; raises an Exception listing
+		# the failed uploads (after trying all of them) if any failed.
+		remote = self.remote_files()
+
+		def upload_one(path):
+			fn = os.path.basename(path)
+			try:
+				md5, size = package_checksum(path)
+
+				if remote.get(fn) == size and self._verify(fn, md5, size):
+					self._progress("  already there: %s" % fn)
+					return fn, None
+
+				offset = remote.get(fn + '.part', 0)
+				for attempt in xrange(self.retries + 1):
+					if offset > size:
+						offset = 0
+					with open(path, 'rb') as fp:
+						fp.seek(offset)
+						self.run('cat %s %s' % ('>>' if offset else '>', self._path(fn + '.part')), stdin=fp)
+
+					if self._verify(fn + '.part', md5, size, rename_to=fn):
+						self._progress("  uploaded:      %s (%s%d bytes)" % (fn, "resumed at %d, " % offset if offset else "", size))
+						return fn, None
+
+					self._progress("  checksum mismatch: %s%s" % (fn, "; retrying" if attempt < self.retries else ""))
+					offset = 0
+
+				return fn, "%s: checksum mismatch after upload" % fn
+			except Exception as e:
+				return fn, "%s: %s" % (fn, e)
+
+		if self.jobs > 1 and len(files) > 1:
+			pool = ThreadPool(min(self.jobs, len(files)))
+			try:
+				results = pool.map(upload_one, files)
+			finally:
+				pool.close()
+		else:
+			results = [ upload_one(path) for path in files ]
+
+		errors = [ error for fn, error in results if error is not None ]
+		if errors:
+			raise Exception("Failed to upload:\n  " + "\n  ".join(errors))
+
+		return [ fn for fn, error in results ]
+
+	def update_repodata(self, packages, verify=False):
+		#
+		# Add the packages (a dict of filename -> repodata.json entry, see
+		# package_info) to the channel's repodata.json (and repodata.json.bz2),
+		# without reindexing the whole channel with 'conda index'.
+		#
+		# The server's repodata.json is merged with the new entries here, and
+		# the result is swapped in only if repodata.json hasn't changed on the
+		# server in the meantime. If verify=True, the md5 sums of the packages
+		# on the server are checked against their entries first.
+		#
+		# Returns False (leaving the index untouched) if repodata.json doesn't
+		# exist yet, it changed under us, or the checksums didn't match; the
+		# caller should run 'conda index' then.
+		#
+		import bz2
+		from cStringIO import StringIO
+
+		if verify:
+			fns = sorted(packages)
+			for chunk in [ fns[i:i+200] for i in xrange(0, len(fns), 200) ]:
+				args = ' '.join(pipes.quote(fn) for fn in chunk)
+				retcode, out = self.run('cd {dir} && {{ md5sum -- {args} 2>/dev/null || md5 -r {args}; }}'.format(dir=self._path(), args=args), check=False)
+				md5s = dict((fn, md5) for md5, fn in (line.split(None, 1) for line in out.splitlines()))
+				if retcode or any(md5s.get(fn) != packages[fn]['md5'] for fn in chunk):
+					return False
+
+		retcode, old = self.run('cat %s 2>/dev/null' % self._path('repodata.json'), check=False)
+		if retcode:
+			return False
+
+		try:
+			repodata = json.loads(old)
+			repodata['packages'].update(packages)
+		except (ValueError, KeyError, TypeError, AttributeError):
+			return False
+		text = json.dumps(repodata, indent=2, sort_keys=True)
+
+		for fn, data in [ ('repodata.json.tmp', text), ('repodata.json.bz2.tmp', bz2.compress(text)) ]:
+			self.run('cat > %s' % self._path(fn), stdin=StringIO(data))
+
+		cmd = 'cd {dir} && test "$({md5sum})" = {md5} && mv -f repodata.json.bz2.tmp repodata.json.bz2 && mv -f repodata.json.tmp repodata.json' \
+			.format(dir=self._path(), md5sum=_md5sum('repodata.json'), md5=hashlib.md5(old).hexdigest())
+		retcode, _ = self.run(cmd, check=False)
+		if retcode:
+			self.run('rm -f %s %s' % (self._path('repodata.json.tmp'), self._path('repodata.json.bz2.tmp')), check=False)
+			return False
+
+		return True
+
+	def _verify(self, fn, md5, size, rename_to=None):
+		# Check the size and md5 of fn on the server (and if they match, rename
+		# it to rename_to). Returns True if they matched.
+		# (wc's output isn't quoted, as BSD wc pads it with spaces)
+		path = self._path(fn)
+		cmd = 'test $(wc -c < {path}) -eq {size} && test "$({md5sum})" = {md5}'.format(path=path, size=size, md5sum=_md5sum(path), md5=md5)
+		if rename_to is not None:
+			cmd += ' && mv -f {path} {dest}'.format(path=path, dest=self._path(rename_to))
+		retcode, _ = self.run(cmd, check=False)
+		return retcode == 0
+
+def _md5sum(path):
+	# A shell command printing the md5 of the file at (the quoted) path,
+	# with md5sum or, where there's none (BSD/macOS), md5
+	return '{{ md5sum < {path} 2>/dev/null || md5 -q < {path}; }} | cut -d" " -f1'.format(path=path)
+
+_repodata_cache = {}
+_repodata_lock = threading.Lock()
+
+def package_info(path):
+	# Return the repodata.json entry (the package's info/index.json, plus its
+	# md5 and size) of the package at path, from the repodata.json of its
+	# (local) channel, or computed from the file if it's not listed there
+	# (or the listing is out of date)
+	dir, fn = os.path.split(os.path.abspath(path))
+
+	with _repodata_lock:
+		if dir not in _repodata_cache:
+			try:
+				with open(os.path.join(dir, 'repodata.json')) as fp:
+					_repodata_cache[dir] = json.load(fp)['packages']
+			except (IOError, ValueError, KeyError):
+				_repodata_cache[dir] = {}
+		info = _repodata_cache[dir].get(fn, {})
+
+	size = os.path.getsize(path)
+	if info.get('size') == size and info.get('md5'):
+		return info
+
+	from recipe_db import read_package_files
+	info = json.loads(read_package_files('file://' + os.path.abspath(path), 'info/index.json')['info/index.json'])
+
+	m = hashlib.md5()
+	with open(path, 'rb') as fp:
+		for chunk in iter(lambda: fp.read(1024*1024), ''):
+			m.update(chunk)
+	info.update(md5=m.hexdigest(), size=size)
+	return info
+
+def package_checksum(path):
+	# Return the (md5, size) of the package at path (see package_info)
+	info = package_info(path)
+	return str(info['md5']), info['size']
@@ -3,39 +3,47 @@ import re
 import contextlib
 from collections import OrderedDict
 
-def fill_out_template(dest_file, template_file, **variables):
-	# fill out a template file
+def fill_template(template, **variables):
+	# fill out a template string
+	text = template % variables
+	
+	# strip template comments
+	text = re.sub(r'^#--.*\n', r'', text, flags=re.MULTILINE)
+
+	return text
+
+def render_template(template_file, **variables):
+	# fill out a template file, returning the result as a string
 	if not os.path.isabs(template_file):
 		template_file = os.path.join(root_dir, 'templates', template_file)
 	with open(template_file) as fp:
 		template = fp.read()
 
-	text = template % variables
-	
-	# strip template comments
-	text = re.sub(r'^#--.*\n', r'', text, flags=re.MULTILINE)
+	return fill_template(template, **variables)
+
+def touch(fn):
+	# Create an empty file, unless it already exists
+	if not os.path.exists(fn):
+		with open(fn, 'w'):
+			pass
+
+def write_if_changed(fn, text):
+	# Write text into fn, unless fn already has the same contents
+	if os.path.isfile(fn):
+		with open(fn) as fp:
+			if fp.read() == text:
+				return False
 
-	with open(dest_file, 'w') as fp:
+	with open(fn, 'w') as fp:
 		fp.write(text)
+	return True
 
 def create_yaml_list(elems, SEP='\n    - '):
 	return (SEP + SEP.join(elems)) if elems else ''
 
-def load_manifest(fn):
-	prefix_build = 'build:'
-
-	# is fn a reference to a tag in versiondb (something like 'build:b1497')?
-	if fn.startswith(prefix_build):
-		url = 'https://raw.githubusercontent.com/lsst/versiondb/master/manifests/%s.txt' % fn[len(prefix_build):]
-		import urllib2
-		print url
-		with contextlib.closing(urllib2.urlopen(url)) as fp:
-			lines = fp.read().split('\n')
-	else:
-		# a regular file
-		with open(fn) as fp:
-			lines = fp.read().split('\n')
-
+def parse_manifest(lines):
+	# Parse the lines of a manifest. Returns the build ID (or None) and the
+	# list of (product, sha, version, deps) tuples.
 	def parse_manifest_lines(lines):
 		for line in lines:
 			line = line.strip()
@@ -59,25 +67,85 @@ def load_manifest(fn):
 
 	return build_id, list( parse_manifest_lines(lines[2:]) )
 
-def build_manifest_for_products(top_level_products, manifestFnOrId):
+def load_manifest(fn, store=None):
+	prefix_build = 'build:'
+
+	# is fn a reference to a tag in versiondb (something like 'build:b1497')?
+	if fn.startswith(prefix_build):
+		if store is not None:
+			# look it up in the local manifest store (see manifest_store.ManifestStore)
+			return store.get(fn[len(prefix_build):])
+
+		url = 'https://raw.githubusercontent.com/lsst/versiondb/master/manifests/%s.txt' % fn[len(prefix_build):]
+		import urllib2
+		print url
+		with contextlib.closing(urllib2.urlopen(url)) as fp:
+			lines = fp.read().split('\n')
+	else:
+		# a regular file
+		with open(fn) as fp:
+			lines = fp.read().split('\n')
+
+	return parse_manifest(lines)
+
+def build_manifest_for_products(top_level_products, manifestFnOrId, store=None):
 	# Load the manifest. Returns the OrderedDict and a set of EUPS tags
 	# to associate with the manifest
 
 	products = {}
-	build_id, manifest_lines = load_manifest(manifestFnOrId)
+	build_id, manifest_lines = load_manifest(manifestFnOrId, store)
 	for (product, sha, version, deps) in manifest_lines:
 		products[product] = (product, sha, version, deps)
 
-	# Extract the products of interest (and their dependencies)
+	# Extract the products of interest (and their dependencies), bottom up:
+	# a depth-first traversal of the dependency graph, adding each product
+	# after all of its dependencies. Products already added are not descended
+	# into again, so every product is visited only once.
 	manifest = OrderedDict()
-	def bottom_up_add_to_manifest(product):
-		(product, sha, version, deps) = products[product]
+	for top_level_product in top_level_products:
+		if top_level_product in manifest:
+			continue
+
+		path, on_path = [ top_level_product ], set([ top_level_product ])	# the products being descended into
+		stack = [ iter(products[top_level_product][3]) ]			# ... and their remaining dependencies
+		while stack:
+			for dep in stack[-1]:
+				if dep in manifest:
+					continue
+				if dep in on_path:
+					raise Exception("Circular dependency in manifest: %s" % ' -> '.join(path[path.index(dep):] + [ dep ]))
+
+				path.append(dep)
+				on_path.add(dep)
+				stack.append(iter(products[dep][3]))
+				break
+			else:
+				stack.pop()
+				product = path.pop()
+				on_path.remove(product)
+				manifest[product] = products[product]
+
+	return manifest, [ build_id ] if build_id is not None else []
+
+def diff_manifests(old, new):
+	# Compare two manifests (OrderedDicts, as returned by build_manifest_for_products).
+	# Returns three lists:
+	#	changed:  products that are new, or whose SHA1, version or dependencies changed
+	#	affected: the changed products and everything in new that (transitively)
+	#		  depends on them, i.e. what needs rebuilding, in manifest (build) order
+	#	removed:  products in old that are no longer in new
+	changed = [ product for product in new if old.get(product) != new[product] ]
+
+	dependents = {}
+	for (product, sha, version, deps) in new.itervalues():
 		for dep in deps:
-			bottom_up_add_to_manifest(dep)
-		if product not in manifest:
-			manifest[product] = products[product]
+			dependents.setdefault(dep, []).append(product)
 
-	for product in top_level_products:
-		bottom_up_add_to_manifest(product)
+	affected, stack = set(changed), list(changed)
+	while stack:
+		for product in dependents.get(stack.pop(), []):
+			if product not in affected:
+				affected.add(product)
+				stack.append(product)
 
-	return manifest, [ build_id ] if build_id is not None else []
+	return changed, [ product for product in new if product in affected ], [ product for product in old if product not in new ]
@@ -1,11 +1,196 @@
 import re
 import subprocess
 import os
+import time
+import shutil
+import threading
+from multiprocessing.pool import ThreadPool
 
-# The path to the extract-version utility, computed as relative to this scripts' path
-extract_version_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'scripts', 'extract-version')
+# EUPS version formats (without the +<plusver> suffix); see eups_to_conda_version
+full_version_re     = re.compile(r'^([^-]+)-([0-9]+)-g([0-9a-z]+)$')	# <vername>-<tagdist>-g<sha1>
+lsst_patchlevel_re  = re.compile(r'^(.*?).?lsst([0-9]+)$')		# <version>.lsst<N>
+branch_sha1_re      = re.compile(r'^([^-]+)-g([0-9a-z]+)$')		# <branch>-g<sha1>
 
-def eups_to_conda_version(product, eups_version, giturl):
+def branch_sha1(eups_version):
+	# Return the SHA1 if eups_version is of the <branch>-g<sha1> form (and
+	# therefore needs the commit timestamp to be converted), None otherwise
+	raw_version = eups_version.split('+')[0]
+	if full_version_re.match(raw_version) or lsst_patchlevel_re.match(raw_version):
+		return None
+
+	match = branch_sha1_re.match(raw_version)
+	return match.group(2) if match else None
+
+class GitTimestampResolver(object):
+	#
+	# Resolves git SHA1s to (formatted, UTC) commit timestamps, to construct
+	# orderable versions for EUPS versions that only give a SHA1.
+	#
+	# The repositories are mirrored in cache_dir/<reponame>.git (the same
+	# layout scripts/extract-version uses). A mirror is only refreshed if it
+	# doesn't already have the commits we're looking for, at most once per
+	# run, and up to `jobs` mirrors are refreshed at the same time (each git
+	# command is given `timeout` seconds to finish). All SHA1s of a repository
+	# are looked up with a single 'git cat-file --batch' call.
+	#
+	# As SHA1s are immutable, the results are kept in a persistent cache
+	# (cache_dir/timestamps.txt) that never needs to be invalidated.
+	#
+	def __init__(self, cache_dir, jobs=1, timeout=None):
+		self.cache_dir = cache_dir
+		self.cache_fn = os.path.join(cache_dir, 'timestamps.txt')
+		self.jobs = max(1, jobs)
+		self.timeout = timeout
+
+		self._timestamps = None		# (giturl, sha1) -> timestamp, loaded on first use
+		self._updated = set()		# mirrors updated in this run
+
+	def _load(self):
+		if self._timestamps is not None:
+			return
+
+		self._timestamps = {}
+		if os.path.isfile(self.cache_fn):
+			with open(self.cache_fn) as fp:
+				for line in fp:
+					giturl, sha1, timestamp = line.split()
+					self._timestamps[giturl, sha1] = timestamp
+
+	def _save(self, timestamps):
+		# Append newly resolved timestamps to the cache file
+		if not os.path.isdir(self.cache_dir):
+			os.makedirs(self.cache_dir)
+		with open(self.cache_fn, 'a') as fp:
+			for (giturl, sha1), timestamp in timestamps.iteritems():
+				fp.write("%s %s %s\n" % (giturl, sha1, timestamp))
+
+	def _git(self, args, cwd=None):
+		# Run a git command, killing it if it takes longer than self.timeout
+		timed_out = []
+		def kill():
+			timed_out.append(True)
+			proc.kill()
+
+		with open(os.devnull, 'w') as devnull:
+			proc = subprocess.Popen(['git'] + args, cwd=cwd, stdout=devnull)
+			timer = threading.Timer(self.timeout, kill) if self.timeout else None
+			if timer is not None:
+				timer.start()
+			try:
+				retcode = proc.wait()
+			finally:
+				if timer is not None:
+					timer.cancel()
+
+		if timed_out:
+			raise Exception("'git %s' timed out after %ss" % (' '.join(args), self.timeout))
+		if retcode:
+			raise subprocess.CalledProcessError(retcode, 'git ' + ' '.join(args))
+
+	def gitdir(self, giturl):
+		# The directory with the mirror of giturl
+		return os.path.join(self.cache_dir, os.path.basename(giturl) + '.git')
+
+	def mirror(self, giturl):
+		# Make sure the mirror of the repository at giturl is up-to-date
+		gitdir = self.gitdir(giturl)
+		if gitdir in self._updated:
+			return
+
+		if os.path.isdir(gitdir) and subprocess.check_output(['git', 'config', '--get', 'remote.origin.url'], cwd=gitdir).strip() != giturl:
+			shutil.rmtree(gitdir)
+
+		if not os.path.isdir(gitdir):
+			try:
+				self._git(['clone', '-q', '--mirror', giturl, gitdir])
+			except:
+				shutil.rmtree(gitdir, ignore_errors=True)
+				raise
+		else:
+			self._git(['remote', 'update'], cwd=gitdir)
+		self._updated.add(gitdir)
+
+	def resolve(self, commits):
+		# Given a list of (giturl, sha1), return a dict of (giturl, sha1) -> timestamp
+		self._load()
+
+		# Group the ones we don't know about by repository
+		missing = {}
+		for giturl, sha1 in commits:
+			if (giturl, sha1) not in self._timestamps:
+				missing.setdefault(giturl, set()).add(sha1)
+
+		def lookup(giturl, sha1s):
+			# Returns ({ sha1: commit_time }, error)
+			gitdir = self.gitdir(giturl)
+			found = read_commit_times(gitdir, sha1s) if os.path.isdir(gitdir) else {}
+			if len(found) == len(sha1s):
+				return found, None
+
+			# Some commits are not in the mirror (or there's no mirror); refresh it
+			try:
+				self.mirror(giturl)
+			except Exception as e:
+				return found, "%s: %s" % (giturl, e)
+
+			found = read_commit_times(gitdir, sha1s)
+			notfound = [ sha1 for sha1 in sha1s if sha1 not in found ]
+			return found, "%s: commit(s) %s not found" % (giturl, ', '.join(notfound)) if notfound else None
+
+		repos = sorted(missing)
+		if len(repos) > 1 and self.jobs > 1:
+			pool = ThreadPool(min(self.jobs, len(repos)))
+			try:
+				results = pool.map(lambda giturl: lookup(giturl, sorted(missing[giturl])), repos)
+			finally:
+				pool.close()
+		else:
+			results = [ lookup(giturl, sorted(missing[giturl])) for giturl in repos ]
+
+		new, errors = {}, []
+		for giturl, (found, error) in zip(repos, results):
+			for sha1, ctime in found.iteritems():
+				new[giturl, sha1] = time.strftime('%Y%m%d%H%M%S', time.gmtime(ctime))
+			if error is not None:
+				errors.append(error)
+
+		if new:
+			self._timestamps.update(new)
+			self._save(new)
+
+		if errors:
+			raise Exception("Failed to resolve commit timestamps:\n  " + "\n  ".join(errors))
+
+		return dict((key, self._timestamps[key]) for key in commits)
+
+def read_commit_times(gitdir, sha1s):
+	# Return a dict of sha1 -> commit time (UNIX time) for the sha1s (may
+	# be abbreviated) found in the repository at gitdir
+	proc = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=gitdir, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+	out, _ = proc.communicate(''.join(sha1 + '\n' for sha1 in sha1s))
+	if proc.returncode:
+		raise subprocess.CalledProcessError(proc.returncode, 'git cat-file --batch')
+
+	# The output is, for each sha1, either '<sha1> missing' (or 'ambiguous'),
+	# or '<full_sha1> <type> <size>' followed by <size> bytes of the object
+	times, pos = {}, 0
+	for sha1 in sha1s:
+		eol = out.index('\n', pos)
+		header = out[pos:eol].split()
+		pos = eol + 1
+		if len(header) != 3:
+			continue
+
+		_, typ, size = header
+		body = out[pos:pos + int(size)]
+		pos += int(size) + 1
+
+		match = re.search(r'^committer .* (\d+) [+-]\d{4}$', body, re.MULTILINE)
+		if typ == 'commit' and match:
+			times[sha1] = int(match.group(1))
+	return times
+
+def eups_to_conda_version(product, eups_version, giturl, timestamps):
 	# Convert EUPS version string to Conda-compatible pieces
 	#
 	# Conda version has three parts:
@@ -16,6 +201,10 @@ def eups_to_conda_version(product, eups_version, giturl):
 	#  Furthermore, it parses the version itself as described in the VersionOrder object docstring at:
 	#      https://github.com/conda/conda/blob/master/conda/resolve.py
 	#  We do our best here to fit into that format.
+	#
+	#  For <branch>-g<sha1> versions, the commit timestamp is looked up in the
+	#  timestamps dict ((giturl, sha1) -> timestamp), which must have been filled
+	#  in by GitTimestampResolver.resolve() beforehand.
 
 	# hardcoded for now. This should be incremented on a case-by-case basis to
 	# push fixes that are Conda-build related
@@ -37,7 +226,7 @@ def eups_to_conda_version(product, eups_version, giturl):
 	#
 
 	def parse_full_version(version, giturl):	
-		match = re.match('^([^-]+)-([0-9]+)-g([0-9a-z]+)$', version)
+		match = full_version_re.match(version)
 		if not match: return None, None
 
 		vername, tagdist, sha1  = match.groups()
@@ -51,19 +240,19 @@ def eups_to_conda_version(product, eups_version, giturl):
 
 	def parse_lsst_patchlevel(version, giturl):
 		# handle 1.2.3.lsst5 --> 1.2.3.5
-		match = re.match(r'^(.*?).?lsst([0-9]+)$', version)
+		match = lsst_patchlevel_re.match(version)
 		if not match: return None, None
 
 		true_ver, lsst_patch = match.groups()
 		return "%s.%s" % (true_ver, lsst_patch), ''
 
 	def parse_branch_sha1(version, giturl):
-		match = re.match('^([^-]+)-g([0-9a-z]+)$', version)
+		match = branch_sha1_re.match(version)
 		if not match: return None, None
 
 		branch, sha1 = match.groups()
 		
-		timestamp = subprocess.check_output([extract_version_path, giturl, sha1]).strip()
+		timestamp = timestamps[giturl, sha1]
 		version = "%s.%s" % (branch, timestamp)
 
 		return version, sha1